@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+'''
+Admission control
+
+Expensive routes get a per-worker concurrency limit with a short queue behind
+it. Once the queue is full, or a queued request has waited too long, further
+requests are shed with a 503 and a Retry-After header instead of tying up the
+worker's threads, so cheap requests keep being served during a burst.
+
+Authenticated requests are also rate limited per token subject (the JWT
+'sub' claim) with a token bucket, answered with a 429 and Retry-After.
+
+Both are kept in process, so limits apply per gunicorn worker process.
+'''
+
+# seconds a queued request waits for a slot before it is shed
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1))
+# value of the Retry-After header on shed requests
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+# sustained requests per minute allowed per token, 0 disables rate limiting
+RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE', 600))
+# requests a token can make in a burst above the sustained rate
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 60))
+# subjects tracked before idle buckets are pruned
+RATE_LIMIT_MAX_SUBJECTS = 10000
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrent, max_queued,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    # acquire()
+    #   returns True once the request may run, or False if it is shed because
+    #   the queue is full or no slot freed up within queue_timeout
+    def acquire(self):
+        with self._condition:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+
+            if self.queued >= self.max_queued:
+                self.shed += 1
+                return False
+
+            self.queued += 1
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.active < self.max_concurrent,
+                    self.queue_timeout)
+            finally:
+                self.queued -= 1
+
+            if not admitted:
+                self.shed += 1
+                return False
+
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def metrics(self):
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'max_concurrent': self.max_concurrent,
+            'max_queued': self.max_queued,
+            'shed': self.shed
+        }
+
+
+class TokenRateLimiter:
+    def __init__(self, per_minute=RATE_LIMIT_PER_MINUTE,
+                 burst=RATE_LIMIT_BURST):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.limited = 0
+        self._buckets = {}  # subject -> (tokens, last refill)
+        self._lock = threading.Lock()
+
+    # check(subject)
+    #   takes a token from the subject's bucket, aborting with 429 if it is
+    #   empty
+    def check(self, subject):
+        if not self.rate or subject is None:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(subject, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens < 1:
+                self.limited += 1
+                self._buckets[subject] = (tokens, now)
+                raise TooManyRequests(
+                    retry_after=max(1, int((1 - tokens) / self.rate + 0.5)))
+
+            self._buckets[subject] = (tokens - 1, now)
+            if len(self._buckets) > RATE_LIMIT_MAX_SUBJECTS:
+                self._prune(now)
+
+    # drops the buckets that have refilled completely, they are equivalent to
+    # a new bucket
+    def _prune(self, now):
+        self._buckets = {
+            subject: (tokens, last)
+            for subject, (tokens, last) in self._buckets.items()
+            if tokens + (now - last) * self.rate < self.burst}
+
+    def metrics(self):
+        return {
+            'subjects': len(self._buckets),
+            'limited': self.limited
+        }
+
+
+token_rate_limiter = TokenRateLimiter()
+
+
+# setup_admission_control(app, route_limits)
+#   applies a ConcurrencyLimiter to each endpoint in route_limits, a dict of
+#   endpoint name -> (max concurrent requests, max queued requests). Returns
+#   the limiters by endpoint.
+def setup_admission_control(app, route_limits):
+    limiters = {
+        endpoint: ConcurrencyLimiter(max_concurrent, max_queued)
+        for endpoint, (max_concurrent, max_queued) in route_limits.items()}
+
+    @app.before_request
+    def admit_request():
+        limiter = limiters.get(request.endpoint)
+        if limiter is None:
+            return
+
+        if not limiter.acquire():
+            raise ServiceUnavailable(retry_after=ADMISSION_RETRY_AFTER)
+        g.admission_limiter = limiter
+
+    @app.teardown_request
+    def release_request(exception):
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
+
+    return limiters
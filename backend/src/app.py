@@ -1,17 +1,138 @@
 import os
-from flask import Flask, request, abort, jsonify, redirect
+import tempfile
+from flask import Flask, request, abort, jsonify, redirect, send_file
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-
-from database.models import setup_db, init_db_data, Movie, Actor
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import HTTPException
+
+from database.models import (
+    setup_db, init_db_data, get_by_ids, unit_of_work, db, Movie, Actor,
+    Casting, Job)
+from database.stats import get_catalog_stats, get_cast_size
+from database.changes import get_changes
+from database.cache import movie_cache
+from database.tenants import current_tenant
+from metrics import register_metrics, collect_metrics
+from jobs import enqueue
+from logs import get_logger, setup_logging, restart_after_fork
+from logs import metrics as logging_metrics
+from admission import setup_admission_control, token_rate_limiter
+from deadlines import setup_deadlines, is_deadline_error
+from idempotency import idempotent
+from idempotency import metrics as idempotency_metrics
+from validation import MOVIE_SCHEMA, ACTOR_SCHEMA, CASTING_SCHEMA
+from slow_queries import recorder as slow_query_recorder
+from slow_queries import setup_slow_query_log, top_slow_queries
+from snapshots import (
+    SNAPSHOTS, SNAPSHOT_FORMATS, arrow_available, write_snapshot)
 from auth.auth import AuthError, requires_auth, AUTH0_DOMAIN, API_AUDIENCE
+from auth.policy import metrics as auth_denial_metrics
+
+log = get_logger(__name__)
+
+# largest number of ids accepted by the batch endpoints
+MAX_BATCH_IDS = int(os.environ.get('MAX_BATCH_IDS', 100))
+# most actors added by one bulk POST /actors
+MAX_BULK_ACTORS = int(os.environ.get('MAX_BULK_ACTORS', 100))
+# largest page of change events returned by /changes
+MAX_CHANGES_PAGE = int(os.environ.get('MAX_CHANGES_PAGE', 1000))
+# movies with a larger cast are deleted by a background job
+ASYNC_CAST_THRESHOLD = int(os.environ.get('ASYNC_CAST_THRESHOLD', 500))
+# requests to an expensive route one worker serves at once, and how many more
+# may wait for a slot before further requests are shed with a 503
+EXPENSIVE_ROUTE_CONCURRENCY = int(
+    os.environ.get('EXPENSIVE_ROUTE_CONCURRENCY', 2))
+EXPENSIVE_ROUTE_QUEUE = int(os.environ.get('EXPENSIVE_ROUTE_QUEUE', 4))
+# seconds an expensive route may take, other routes get REQUEST_DEADLINE
+EXPENSIVE_ROUTE_DEADLINE = float(
+    os.environ.get('EXPENSIVE_ROUTE_DEADLINE', 20))
+
+
+# get_id_list(arg)
+#   parses a comma separated list of integer ids from the query string,
+#   i.e. '?ids=1,2,3'. Aborts with 400 if the list is missing, malformed or
+#   longer than MAX_BATCH_IDS.
+def get_id_list(arg='ids'):
+    try:
+        ids = [int(i) for i in request.args.get(arg, '').split(',') if i]
+    except ValueError:
+        abort(400)
+
+    if not ids or len(ids) > MAX_BATCH_IDS:
+        abort(400)
+
+    # drops duplicates but keeps the order they were requested in
+    return list(dict.fromkeys(ids))
+
+
+# reraise_deadline_errors(error)
+#   re-raises the errors a write route must not turn into a 422: aborts
+#   (i.e. the 504 of a request whose deadline passed) and queries cancelled
+#   by the deadline's statement timeout
+def reraise_deadline_errors(error):
+    if isinstance(error, HTTPException) or is_deadline_error(error):
+        raise error
+
+
+# accepted(job)
+#   the 202 response returned when a request is handed to a background job.
+#   The job's progress can be followed at the Location header.
+def accepted(job):
+    response = jsonify({
+        'success': True,
+        'job': job.format()
+    })
+    response.status_code = 202
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response
+
+
+# check_if_match(row)
+#   aborts with 412 if the request has an If-Match header that does not match
+#   the row's current version. Requests without the header are not checked.
+def check_if_match(row):
+    if request.if_match and not request.if_match.contains(str(row.version)):
+        abort(412)
+
+
+# versioned(response, row)
+#   adds the row's version as the response's ETag, for use in If-Match
+def versioned(response, row):
+    response.set_etag(str(row.version))
+    return response
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
     setup_db(app)
+    setup_logging(app)
     CORS(app)
+    register_metrics('movie_cache', movie_cache.metrics)
+    register_metrics('logging', logging_metrics)
+
+    # unpaginated and batch reads serialize large payloads, so only a few of
+    # them run at once and bursts are shed instead of starving cheap requests
+    expensive_routes = [
+        'get_movies', 'get_actors', 'get_cast_for_movie',
+        'get_casts_for_movies', 'get_filmographies', 'get_change_feed',
+        'get_snapshot']
+
+    # the deadline starts before admission so queueing time counts against it
+    setup_deadlines(app, {
+        endpoint: EXPENSIVE_ROUTE_DEADLINE for endpoint in expensive_routes})
+    limiters = setup_admission_control(app, {
+        endpoint: (EXPENSIVE_ROUTE_CONCURRENCY, EXPENSIVE_ROUTE_QUEUE)
+        for endpoint in expensive_routes})
+    register_metrics('admission', lambda: {
+        endpoint: limiter.metrics() for endpoint, limiter in limiters.items()})
+    register_metrics('rate_limit', token_rate_limiter.metrics)
+    register_metrics('auth_denials', auth_denial_metrics)
+    register_metrics('idempotency', idempotency_metrics)
+    setup_slow_query_log(app)
+    register_metrics('slow_queries', slow_query_recorder.metrics)
 
     # UNCOMMENT THE LINE 18 AND
     #   RUN ONCE TO INITIALIZE DATABASE WITH DUMMY DATA
@@ -50,6 +171,14 @@ def create_app(test_config=None):
     @app.route('/movies', methods=['GET'])
     @requires_auth(permission='get:movies')
     def get_movies():
+        if 'ids' in request.args:
+            movies, missing_ids = movie_cache.get_many(get_id_list())
+            return jsonify({
+                'success': True,
+                'movies': movies,
+                'missing_ids': missing_ids,
+                'total_num_movies': len(movies)})
+
         movies = Movie.query.all()
 
         if movies:
@@ -63,6 +192,14 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['GET'])
     @requires_auth(permission='get:actors')
     def get_actors():
+        if 'ids' in request.args:
+            actors, missing_ids = get_by_ids(Actor, get_id_list())
+            return jsonify({
+                'success': True,
+                'actors': [actor.format() for actor in actors],
+                'missing_ids': missing_ids,
+                'total_num_actors': len(actors)})
+
         actors = Actor.query.all()
 
         if not actors:
@@ -77,61 +214,204 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
     @requires_auth(permission='get:actors')
     def get_cast_for_movie(movie_id):
-        actors = Actor.query.filter(Actor.movie_id == movie_id).all()
+        actors = Actor.query.join(Actor.castings).filter(
+            Casting.movie_id == movie_id).all()
 
         if not actors:
             abort(404)
 
-        movie = Movie.query.get(movie_id)
         return jsonify({
             'success': True,
             'actors': [actor.format() for actor in actors],
             'num_actors': len(actors),
-            'current_movie': movie.format()
+            'current_movie': movie_cache.get(movie_id)
+        })
+
+    @app.route('/movies/casts', methods=['GET'])
+    @requires_auth(permission='get:actors')
+    def get_casts_for_movies():
+        movie_ids = get_id_list()
+        # the actors in one query, and their castings (which format() needs)
+        # in one more, however large the casts are
+        actors = Actor.query.join(Actor.castings).filter(
+            Casting.movie_id.in_(movie_ids)).order_by(Actor.id).all()
+
+        casts = {movie_id: [] for movie_id in movie_ids}
+        for actor in actors:
+            formatted = actor.format()
+            for casting in actor.castings:
+                if casting.movie_id in casts:
+                    casts[casting.movie_id].append(
+                        dict(formatted, role=casting.role))
+
+        return jsonify({
+            'success': True,
+            'casts': casts
+        })
+
+    @app.route('/actors/filmographies', methods=['GET'])
+    @requires_auth(permission='get:actors')
+    def get_filmographies():
+        actor_ids = get_id_list()
+        castings = Casting.query.filter(Casting.actor_id.in_(actor_ids)).all()
+
+        filmographies = {actor_id: [] for actor_id in actor_ids}
+        for casting in castings:
+            filmographies[casting.actor_id].append(
+                dict(casting.format(), movie=casting.movie.format()))
+
+        return jsonify({
+            'success': True,
+            'filmographies': filmographies
+        })
+
+    @app.route('/changes', methods=['GET'])
+    @requires_auth(permission='get:movies')
+    def get_change_feed():
+        since = request.args.get('since', 0, type=int)
+        limit = request.args.get('limit', 100, type=int)
+
+        if since < 0 or not 0 < limit <= MAX_CHANGES_PAGE:
+            abort(400)
+
+        changes, next_cursor = get_changes(since, limit)
+        return jsonify({
+            'success': True,
+            'changes': [change.format() for change in changes],
+            'next_cursor': next_cursor,
+            'has_more': len(changes) == limit
+        })
+
+    @app.route('/stats', methods=['GET'])
+    @requires_auth(permission='get:actors')
+    def get_stats():
+        return jsonify({
+            'success': True,
+            'stats': get_catalog_stats()
+        })
+
+    @app.route('/stats/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth(permission='get:actors')
+    def get_movie_stats(movie_id):
+        if not movie_cache.get(movie_id):
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie_id': movie_id,
+            'cast_size': get_cast_size(movie_id)
+        })
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return jsonify({
+            'success': True,
+            'metrics': collect_metrics()
+        })
+
+    @app.route('/admin/snapshots/<name>', methods=['GET'])
+    @requires_auth(permission='read:admin')
+    def get_snapshot(name):
+        if name not in SNAPSHOTS:
+            abort(404)
+
+        file_format = request.args.get('format', 'parquet')
+        if file_format not in SNAPSHOT_FORMATS:
+            abort(400)
+        if not arrow_available():
+            abort(501)
+
+        # written to disk rather than memory, then streamed back
+        snapshot = tempfile.TemporaryFile()
+        write_snapshot(name, snapshot, file_format, tenant=current_tenant())
+        snapshot.seek(0)
+
+        extension, mimetype = SNAPSHOT_FORMATS[file_format]
+        return send_file(
+            snapshot,
+            mimetype=mimetype,
+            as_attachment=True,
+            attachment_filename=f'{name}.{extension}')
+
+    @app.route('/admin/slow-queries', methods=['GET'])
+    @requires_auth(permission='read:admin')
+    def get_slow_queries():
+        limit = request.args.get('limit', 20, type=int)
+        if not 0 < limit <= 100:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'slow_queries': [
+                query.format() for query in top_slow_queries(limit)]
         })
 
     @app.route('/movies', methods=['POST'])
     @requires_auth(permission='post:movies')
+    @idempotent
     def create_movie():
-        body = request.get_json()
+        values = MOVIE_SCHEMA.validate(request.get_json())
 
         try:
-            new_movie = Movie(
-                title=body.get('title', None),
-                release=body.get('release', None)
-            )
-            new_movie.insert()
+            with unit_of_work() as session:
+                new_movie = Movie(
+                    title=values['title'],
+                    release=values['release']
+                )
+                session.add(new_movie)
+                session.flush()
             return jsonify({
                 'success': True,
                 'new_movie_id': new_movie.id
             })
 
-        except Exception as e:
-            print(e)
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('movie not created')
             abort(422)
 
     @app.route('/actors', methods=['POST'])
     @requires_auth(permission='post:actors')
+    @idempotent
     def add_actor():
         body = request.get_json()
+        # a list of actors is added in one transaction, validated in one pass
+        bulk = isinstance(body, list)
+        if bulk and not 0 < len(body) <= MAX_BULK_ACTORS:
+            abort(400)
+        actors = ACTOR_SCHEMA.validate_many(body) if bulk else [
+            ACTOR_SCHEMA.validate(body)]
 
-        # debug errors adding movie id
         try:
-            new_actor = Actor(
-                name=body.get('name', None),
-                age=body.get('age', None),
-                gender=body.get('gender', None),
-            )
-            new_actor.movie_id = body.get('movie_id', None)
-
-            new_actor.insert()
+            with unit_of_work() as session:
+                new_actors = []
+                for values in actors:
+                    new_actor = Actor(
+                        name=values['name'],
+                        age=values['age'],
+                        gender=values['gender'],
+                    )
+                    if values.get('movie_id') is not None:
+                        new_actor.cast_in(
+                            values['movie_id'], role=values.get('role'))
+                    new_actors.append(new_actor)
+
+                session.add_all(new_actors)
+                session.flush()
+
+            if bulk:
+                return jsonify({
+                    'success': True,
+                    'new_actor_ids': [actor.id for actor in new_actors]
+                })
             return jsonify({
                 'success': True,
-                'new_actor_id': new_actor.id
+                'new_actor_id': new_actors[0].id
             })
 
-        except Exception as e:
-            print(e)
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('actor not added')
             abort(422)
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
@@ -142,20 +422,26 @@ def create_app(test_config=None):
         if not movie:
             abort(404)
 
-        body = request.get_json()
+        check_if_match(movie)
+        values = MOVIE_SCHEMA.validate(request.get_json(), partial=True)
         try:
-            movie.title = body.get('title', movie.title)
-            movie.release = body.get('release', movie.release)
-            movie.update()
-            return jsonify({
-                'success': True,
-                'updated_movie': movie.format()
-            })
-
-        except Exception as e:
-            print(e)
+            with unit_of_work():
+                movie.title = values.get('title', movie.title)
+                movie.release = values.get('release', movie.release)
+
+        except StaleDataError:
+            # updated by another request since it was read
+            abort(412)
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('movie not updated')
             abort(422)
 
+        return versioned(jsonify({
+            'success': True,
+            'updated_movie': movie.format()
+        }), movie)
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth(permission='patch:actors')
     def update_actor(actor_id):
@@ -164,48 +450,137 @@ def create_app(test_config=None):
         if not actor:
             abort(404)
 
+        check_if_match(actor)
+
         # consider taking movie title and then searching databse for ID for 4th
         # attribute
-        body = request.get_json()
+        values = ACTOR_SCHEMA.validate(request.get_json(), partial=True)
+        try:
+            with unit_of_work():
+                actor.name = values.get('name', actor.name)
+                actor.age = values.get('age', actor.age)
+                actor.gender = values.get('gender', actor.gender)
+                if values.get('movie_id') is not None:
+                    actor.cast_in(
+                        values['movie_id'], role=values.get('role'))
+
+        except StaleDataError:
+            # updated by another request since it was read
+            abort(412)
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('actor not updated')
+            abort(422)
+
+        return versioned(jsonify({
+            'success': True,
+            'updated_actor': actor.format()
+        }), actor)
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth(permission='patch:actors')
+    def cast_actor(movie_id):
+        values = CASTING_SCHEMA.validate(request.get_json())
+        movie = Movie.query.get(movie_id)
+        actor = Actor.query.get(values['actor_id'])
+
+        if not movie or not actor:
+            abort(404)
+
+        try:
+            with unit_of_work():
+                casting = actor.cast_in(
+                    movie.id,
+                    role=values.get('role'),
+                    start_date=values.get('start_date'),
+                    end_date=values.get('end_date'))
+            return jsonify({
+                'success': True,
+                'casting': casting.format()
+            })
+
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('actor not cast')
+            abort(422)
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth(permission='patch:actors')
+    def uncast_actor(movie_id, actor_id):
+        casting = Casting.query.get((movie_id, actor_id))
+
+        if not casting:
+            abort(404)
+
         try:
-            actor.name = body.get('name', actor.name)
-            actor.age = body.get('age', actor.age)
-            actor.gender = body.get('gender', actor.gender)
-            actor.movie_id = body.get('movie_id', actor.movie_id)
-            actor.update()
+            casting.delete()
             return jsonify({
                 'success': True,
-                'updated_actor': actor.format()
+                'deleted_casting': {
+                    'movie_id': movie_id,
+                    'actor_id': actor_id
+                }
             })
 
-        except Exception as e:
-            print(e)
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('casting not deleted')
             abort(422)
 
+    @app.route('/movies/<int:movie_id>/actors/reassign', methods=['POST'])
+    @requires_auth(permission='patch:actors')
+    def reassign_cast(movie_id):
+        body = request.get_json()
+
+        if not body or 'to_movie_id' not in body:
+            abort(400)
+
+        if not movie_cache.get(movie_id) or not movie_cache.get(
+                body['to_movie_id']):
+            abort(404)
+
+        return accepted(enqueue(
+            'reassign_cast',
+            movie_id=movie_id,
+            to_movie_id=body['to_movie_id'],
+            role=body.get('role')))
+
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    @requires_auth(permission='get:movies')
+    def get_job(job_id):
+        job = Job.query.get(job_id)
+
+        if not job:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        })
+
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth(permission='delete:movies')
     def delete_movie(movie_id):
         movie = Movie.query.get(movie_id)
-        actors = Actor.query.filter(Actor.movie_id == movie_id).all()
 
         if not movie:
             abort(404)
 
-        try:
-            # erases movie_id attribute for actors currently assigned to the
-            # movie being deleted
-            if actors:
-                for actor in actors:
-                    actor.movie_id = None
-                    actor.update()
+        if (request.args.get('async') == 'true'
+                or get_cast_size(movie_id) > ASYNC_CAST_THRESHOLD):
+            return accepted(enqueue('delete_movie', movie_id=movie_id))
 
+        try:
+            # castings of the movie are deleted with it, actors are kept
             movie.delete()
             return jsonify({
                 'success': True,
                 'deleted_movie_id': movie.id
             })
-        except Exception as e:
-            print(e)
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('movie not deleted')
             abort(422)
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
@@ -223,8 +598,9 @@ def create_app(test_config=None):
                 'deleted_actor_id': actor.id
             })
 
-        except Exception as e:
-            print(e)
+        except Exception as error:
+            reraise_deadline_errors(error)
+            log.exception('actor not deleted')
             abort(422)
 
     # error handlers
@@ -237,10 +613,14 @@ def create_app(test_config=None):
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        response = {
             "error": 422,
             "message": "unprocessable"
-        }), 422
+        }
+        # field errors found by request validation, see validation.py
+        if getattr(error, 'errors', None):
+            response['errors'] = error.errors
+        return jsonify(response), 422
 
     @app.errorhandler(400)
     def bad_request(error):
@@ -256,6 +636,60 @@ def create_app(test_config=None):
             "message": "method not allowed"
         }), 405
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
+    @app.errorhandler(501)
+    def not_implemented(error):
+        return jsonify({
+            "error": 501,
+            "message": "not implemented"
+        }), 501
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "error": 429,
+            "message": "too many requests"
+        })
+        response.status_code = 429
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "error": 503,
+            "message": "service unavailable"
+        })
+        response.status_code = 503
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
+    @app.errorhandler(504)
+    def gateway_timeout(error):
+        return jsonify({
+            "error": 504,
+            "message": "request deadline exceeded"
+        }), 504
+
+    @app.errorhandler(OperationalError)
+    def database_error(error):
+        if is_deadline_error(error):
+            return gateway_timeout(error)
+
+        log.error('database error', exc_info=error)
+        return jsonify({
+            "error": 500,
+            "message": "internal server error"
+        }), 500
+
     @app.errorhandler(AuthError)
     def authentication_error(error):
         return jsonify({
@@ -267,7 +701,25 @@ def create_app(test_config=None):
     return app
 
 
-APP = create_app()
+# reinit_after_fork(app)
+#   resets process-local state in a gunicorn worker forked from a master that
+#   preloaded the app (see gunicorn.conf.py). The worker must not reuse the
+#   master's pooled DB connections, cached rows or locks.
+def reinit_after_fork(app):
+    with app.app_context():
+        try:
+            db.engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33, the master disposes its pool before forking
+            # so there are no inherited connections to close
+            db.engine.dispose()
+
+    movie_cache.after_fork()
+    slow_query_recorder.after_fork()
+    restart_after_fork()
+
 
+# the app is only built when asked for (i.e. by gunicorn's 'app:create_app()'
+# or the worker), so importing this module does no setup work
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
@@ -1,14 +1,51 @@
 import json
 import os
+import socket
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from werkzeug.exceptions import GatewayTimeout, HTTPException
+
+from logs import get_logger, LogSampler
+from admission import token_rate_limiter
+from deadlines import remaining
+from .policy import (
+    Policy, permission_mask, registry_size, register_route, record_denial)
 
 # Global Vars
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'pibcrib.us.auth0.com')
 API_AUDIENCE = os.environ.get('API_AUDIENCE', 'CastingAgency')
 ALGORITHMS = ['RS256']
+JWT_ISSUER = os.environ.get('JWT_ISSUER', f'https://{AUTH0_DOMAIN}/')
+
+# where the public keys that sign tokens come from, checked in this order:
+#   JWKS_FILE   path to a local JWKS file (for sites without network access)
+#   JWKS        the JWKS document itself
+#   JWKS_URL    URL to download the JWKS from, Auth0's by default
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS = os.environ.get('JWKS')
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# longest the JWKS download may take, shortened to the request's deadline
+JWKS_TIMEOUT = float(os.environ.get('JWKS_TIMEOUT', 5))
+# seconds downloaded keys are used before the JWKS is downloaded again
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 3600))
+# an unknown kid (i.e. after a key rotation) triggers a download at most this
+# often, so tokens with made up kids cannot hammer Auth0
+JWKS_MIN_REFRESH = float(os.environ.get('JWKS_MIN_REFRESH', 60))
+# verified tokens kept per process, so a client's repeated requests skip the
+# signature check until the token expires
+VERIFIED_TOKEN_CACHE_SIZE = int(
+    os.environ.get('VERIFIED_TOKEN_CACHE_SIZE', 1024))
+
+log = get_logger(__name__)
+# auth failures are logged in full up to a burst, then sampled, so an outage
+# or a misbehaving client cannot flood the logs
+auth_failure_sampler = LogSampler(
+    burst=int(os.environ.get('AUTH_LOG_BURST', 10)),
+    every=int(os.environ.get('AUTH_LOG_SAMPLE_EVERY', 100)))
 
 
 # AuthError Exception
@@ -62,22 +99,29 @@ def get_token_auth_header():
         401)
 
 
-#      check_permissions(permission, payload)
+#      check_permissions(policy, payload, mask)
 #           @INPUTS
-#               permission: string permission (i.e. 'post:drink')
+#               policy: compiled Policy, or a string permission
+#                   (i.e. 'post:drink')
 #               payload: decoded jwt payload
+#               mask: bitmask of the payload's permissions, computed from the
+#                   payload if not given (see verify_token())
 #
 #           -raises an AuthError if permissions are not included in the payload
-#           -raises an AuthError if the requested permission string
-#               is not in the payload permissions array
+#           -raises an AuthError if the payload permissions do not satisfy
+#               the policy
 #           -return true otherwise
-def check_permissions(permission, payload):
+def check_permissions(policy, payload, mask=None):
+    if isinstance(policy, str):
+        policy = Policy(all_of=[policy] if policy else [])
+
     # gets list of permissions included in verified JWT payload
-    payload_permissions = payload['permissions']
+    payload_permissions = payload.get('permissions')
     if payload_permissions:
-        for p in payload_permissions:
-            if p == permission:
-                return True
+        if mask is None:
+            mask = permission_mask(payload_permissions)
+        if policy.allows(mask):
+            return True
 
         # raises error if payload_permissions does not contain permission
         # needed to access resource
@@ -97,38 +141,115 @@ def check_permissions(permission, payload):
         403)
 
 
+# public keys (JWKs) by kid, ready to verify signatures with
+_signing_keys = {'keys': {}, 'loaded_at': None}
+_signing_keys_lock = threading.Lock()
+
+
+#      load_jwks()
+#           reads the JWKS document from the configured source (JWKS_FILE,
+#           JWKS or JWKS_URL) and returns it as a dict
+def load_jwks():
+    if JWKS_FILE:
+        with open(JWKS_FILE) as jwks_file:
+            return json.load(jwks_file)
+
+    if JWKS:
+        return json.loads(JWKS)
+
+    from urllib.error import URLError
+    from urllib.request import urlopen
+
+    # gives up at the request's deadline
+    left = remaining()
+    timeout = JWKS_TIMEOUT if left is None else min(left, JWKS_TIMEOUT)
+    try:
+        jsonurl = urlopen(JWKS_URL, timeout=timeout)
+        return json.loads(jsonurl.read())
+    except socket.timeout:
+        raise GatewayTimeout()
+    except URLError as e:
+        if isinstance(e.reason, socket.timeout):
+            raise GatewayTimeout()
+        raise
+
+
+#      parse_jwks(jwks)
+#           returns every RSA signing key in a JWKS document by kid, as the
+#           JWK dict jwt.decode() takes (the pinned python-jose cannot take
+#           parsed key objects). Each key is parsed once here, so a malformed
+#           one is rejected when the keys are loaded.
+def parse_jwks(jwks):
+    from jose import jwk
+
+    keys = {}
+    for key in jwks['keys']:
+        if key.get('kty') == 'RSA' and key.get('use', 'sig') == 'sig':
+            jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+            keys[key['kid']] = key
+    return keys
+
+
+#      get_signing_key(kid)
+#           returns the public key (JWK) with the given kid, or None.
+#           Keys are loaded once. Downloaded keys are refreshed after
+#           JWKS_CACHE_TTL, or early if a token names an unknown kid.
+def get_signing_key(kid):
+    now = time.monotonic()
+    loaded_at = _signing_keys['loaded_at']
+    remote = not (JWKS_FILE or JWKS)
+
+    if loaded_at is not None:
+        key = _signing_keys['keys'].get(kid)
+        expired = remote and now - loaded_at > JWKS_CACHE_TTL
+        if key is not None and not expired:
+            return key
+        if key is None and (not remote or now - loaded_at < JWKS_MIN_REFRESH):
+            return None
+
+    with _signing_keys_lock:
+        # another thread may have reloaded the keys while this one waited
+        if _signing_keys['loaded_at'] == loaded_at:
+            try:
+                keys = parse_jwks(load_jwks())
+            except Exception:
+                # keeps verifying with the keys it has if a refresh fails,
+                # i.e. while Auth0 is unreachable
+                if loaded_at is None:
+                    raise
+                log.warning('JWKS refresh failed', exc_info=True)
+                keys = _signing_keys['keys']
+
+            _signing_keys['keys'] = keys
+            _signing_keys['loaded_at'] = time.monotonic()
+
+    return _signing_keys['keys'].get(kid)
+
+
 #      verify_decode_jwt(token)
 #           @INPUTS
 #           token: a json web token (string)
 #
 #           it should be an Auth0 token with key id (kid)
-#           it should verify the token using Auth0 /.well-known/jwks.json
+#           it should verify the token using the keys from the configured
+#               JWKS source (Auth0 /.well-known/jwks.json by default)
 #           it should decode the payload from the token
 #           it should validate the claims
 #           return the decoded payload
 def verify_decode_jwt(token):
-    # Gets set of public keys used for verifying JWTs issued by Auth0, signed
-    # using RS256
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # imported on first use rather than at module load, jose pulls in its
+    # crypto backends which slows down every worker boot
+    from jose import jwt
 
     # gets ecrypted JWT header from unverified token
     unverified_header = jwt.get_unverified_header(token)
 
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({'code': 'invalid_header',
                         'description': 'Malformed Authorization header.'}, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # public key loaded once from the JWKS, see get_signing_key()
+    rsa_key = get_signing_key(unverified_header['kid'])
 
     # validates JWT, and returns payload if decryption was successful
     if rsa_key:
@@ -139,7 +260,7 @@ def verify_decode_jwt(token):
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer=JWT_ISSUER
             )
 
             return payload
@@ -170,30 +291,98 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-#      requires_auth(permission='')
+# verified tokens -> (payload, permission mask, permissions known when the
+# mask was computed), least recently used first
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
+
+#      verify_token(token)
+#           @INPUTS
+#           token: a json web token (string)
+#
+#           returns the token's decoded payload and its permission bitmask.
+#           Uses verify_decode_jwt() the first time a token is seen, and the
+#           cached result until the token expires.
+def verify_token(token):
+    with _verified_tokens_lock:
+        cached = _verified_tokens.get(token)
+        if cached:
+            _verified_tokens.move_to_end(token)
+
+    if cached and cached[0].get('exp', 0) > time.time():
+        payload, mask, known = cached
+        if known == registry_size():
+            return payload, mask
+    else:
+        payload = verify_decode_jwt(token)
+
+    mask = permission_mask(payload.get('permissions') or [])
+    with _verified_tokens_lock:
+        _verified_tokens[token] = (payload, mask, registry_size())
+        while len(_verified_tokens) > VERIFIED_TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+
+    return payload, mask
+
+
+#      requires_auth(permission='', any_of=(), all_of=())
 #           @INPUTS
 #           permission: string permission (i.e. 'post:drink')
+#           any_of: permissions of which the token needs at least one
+#           all_of: permissions the token needs all of, besides `permission`
 #
+#           compiles the route's policy when the route is declared
 #           uses  get_token_auth_header() to get the token
-#           uses verify_decode_jwt() to decode the jwt
+#           uses verify_token() to decode the jwt
 #           uses check_permissions() to validate claims and check permission
+#           counts denied requests per route for /metrics
+#           applies the per-token rate limit to the token's subject
 # return the decorator which passes the decoded payload to the decorated
 # method
-def requires_auth(permission=''):
+def requires_auth(permission='', any_of=(), all_of=()):
+    policy = Policy(
+        any_of=any_of,
+        all_of=list(all_of) + ([permission] if permission else []))
+
     def requires_auth_decorator(f):
+        register_route(f.__name__, policy)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
             try:
                 token = get_token_auth_header()
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                payload, mask = verify_token(token)
+                check_permissions(policy, payload, mask)
 
             except AuthError as e:
-                print(e)
-                raise e
-            except Exception as e:
-                print(e)
+                record_denial(f.__name__, e.status_code)
+                code = e.error.get('code')
+                should_log, occurrences = auth_failure_sampler.should_log(
+                    code)
+                if should_log:
+                    log.warning('auth failed', extra={
+                        'status': e.status_code,
+                        'auth_error': code,
+                        'occurrences': occurrences})
                 raise e
+            except HTTPException as e:
+                # i.e. a 504 when the JWKS download times out, sampled like
+                # auth failures since an Auth0 outage fails every request
+                should_log, occurrences = auth_failure_sampler.should_log(
+                    e.code)
+                if should_log:
+                    log.warning('auth unavailable', extra={
+                        'status': e.code,
+                        'occurrences': occurrences})
+                raise
+            except Exception:
+                log.exception('auth error')
+                raise
+
+            # rate limited per verified token subject, aborts with 429
+            token_rate_limiter.check(payload.get('sub'))
+            _request_ctx_stack.top.current_user = payload
 
             return f(*args, **kwargs)
 
@@ -0,0 +1,92 @@
+import threading
+
+'''
+Permission policy
+
+Every permission a route can require gets a bit when the route is declared
+(at app construction), and a route's requirement is compiled into bitmasks.
+A verified token's permissions are turned into a bitmask once (see
+verify_token() in auth.py), so authorizing a request is a couple of integer
+operations no matter how many permissions the token carries.
+'''
+
+_permission_bits = {}
+_lock = threading.Lock()
+
+# routes and the policy they were declared with, by endpoint name
+route_policies = {}
+# denied requests by endpoint name and status code
+_denials = {}
+
+
+# permission_bit(permission)
+#   returns the bit assigned to a permission, assigning the next free one the
+#   first time a permission is seen
+def permission_bit(permission):
+    bit = _permission_bits.get(permission)
+    if bit is None:
+        with _lock:
+            bit = _permission_bits.setdefault(
+                permission, 1 << len(_permission_bits))
+    return bit
+
+
+# permission_mask(permissions)
+#   the bitmask of the permissions that any route requires, others are
+#   ignored since no policy can ask for them
+def permission_mask(permissions):
+    mask = 0
+    for permission in permissions:
+        mask |= _permission_bits.get(permission, 0)
+    return mask
+
+
+# the number of permissions known, a mask computed when fewer were known must
+# be computed again
+def registry_size():
+    return len(_permission_bits)
+
+
+class Policy:
+    def __init__(self, any_of=(), all_of=()):
+        self.any_of = tuple(any_of)
+        self.all_of = tuple(all_of)
+        self.any_mask = 0
+        self.all_mask = 0
+        for permission in self.any_of:
+            self.any_mask |= permission_bit(permission)
+        for permission in self.all_of:
+            self.all_mask |= permission_bit(permission)
+
+    # allows(mask)
+    #   whether a token with the given permission mask satisfies the policy
+    def allows(self, mask):
+        if mask & self.all_mask != self.all_mask:
+            return False
+        return not self.any_mask or bool(mask & self.any_mask)
+
+    def format(self):
+        return {
+            'any_of': list(self.any_of),
+            'all_of': list(self.all_of)
+        }
+
+
+# register_route(endpoint, policy)
+#   records the policy a route was declared with
+def register_route(endpoint, policy):
+    route_policies[endpoint] = policy
+
+
+def record_denial(endpoint, status_code):
+    with _lock:
+        by_status = _denials.setdefault(endpoint, {})
+        by_status[status_code] = by_status.get(status_code, 0) + 1
+
+
+def metrics():
+    with _lock:
+        return {
+            endpoint: {
+                str(status): count for status, count in by_status.items()}
+            for endpoint, by_status in _denials.items()}
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from app import create_app
+from database.models import setup_db, db
+from snapshots import (
+    SNAPSHOTS, SNAPSHOT_FORMATS, movie_table, actor_table, casting_table,
+    write_snapshot)
+
+'''
+Snapshot benchmark
+
+Fills a scratch database with --rows actors, ten per movie and each cast in
+one movie, then times writing every snapshot and compares its size with the
+same rows serialized as JSON, the way the API returns them. The database is
+emptied first, never point it at a real one.
+
+Usage, from within backend/src:
+
+    python bench_snapshot.py --rows 1000000
+    python bench_snapshot.py --rows 1000000 --database $BENCH_DATABASE_URL
+'''
+
+SEED_CHUNK_SIZE = 10000
+GENDERS = ['Female', 'Male']
+
+
+def seed(rows):
+    movies = max(1, rows // 10)
+    first_release = datetime(2022, 1, 1)
+    connection = db.session.connection()
+
+    for start in range(0, movies, SEED_CHUNK_SIZE):
+        connection.execute(movie_table.insert(), [{
+            'id': i + 1,
+            'title': f'Movie {i + 1}',
+            'release': first_release + timedelta(days=i % 3650)
+        } for i in range(start, min(start + SEED_CHUNK_SIZE, movies))])
+
+    for start in range(0, rows, SEED_CHUNK_SIZE):
+        ids = range(start, min(start + SEED_CHUNK_SIZE, rows))
+        connection.execute(actor_table.insert(), [{
+            'id': i + 1,
+            'name': f'Actor {i + 1}',
+            'age': 20 + i % 60,
+            'gender': GENDERS[i % 2]
+        } for i in ids])
+        connection.execute(casting_table.insert(), [{
+            'movie_id': i % movies + 1,
+            'actor_id': i + 1,
+            'role': f'Role {i + 1}'
+        } for i in ids])
+
+    db.session.commit()
+
+
+# size of the snapshot's rows as a JSON list of objects, counted a chunk at a
+# time
+def json_size(name):
+    query, columns = SNAPSHOTS[name]()
+    result = db.session.connection().execution_options(
+        stream_results=True).execute(query)
+
+    size = 2
+    while True:
+        chunk = result.fetchmany(SEED_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += sum(
+            len(json.dumps(row._asdict(), default=str)) + 1 for row in chunk)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures snapshot export time and size.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--database', default='sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'castingagency_bench.db'))
+    parser.add_argument(
+        '--format', choices=list(SNAPSHOT_FORMATS), default='parquet')
+    args = parser.parse_args()
+
+    app = create_app()
+    setup_db(app, args.database)
+
+    with app.app_context(), tempfile.TemporaryDirectory() as directory:
+        db.drop_all()
+        db.create_all()
+        started = time.perf_counter()
+        seed(args.rows)
+        print(f'seeded {args.rows} actors in '
+              f'{time.perf_counter() - started:.1f} s')
+
+        print(f'{"":10}{"rows":>10}{"seconds":>10}{"MB":>10}'
+              f'{"JSON MB":>10}{"ratio":>8}')
+        for name in SNAPSHOTS:
+            path = os.path.join(
+                directory, f'{name}.{SNAPSHOT_FORMATS[args.format][0]}')
+            started = time.perf_counter()
+            rows = write_snapshot(name, path, args.format)
+            seconds = time.perf_counter() - started
+            size = os.path.getsize(path)
+            json_bytes = json_size(name)
+            print(f'{name:10}{rows:10}{seconds:10.2f}{size / 2**20:10.1f}'
+                  f'{json_bytes / 2**20:10.1f}{json_bytes / size:8.1f}')
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'peak memory {peak:.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
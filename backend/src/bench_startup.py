@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+'''
+Startup benchmark
+
+Boots the app in fresh interpreter processes, the way every new gunicorn
+worker does, and reports per worker:
+
+    import          time to import app.py and everything it imports
+    create_app      time to build the app
+    first_response  time to serve the first request
+    total           all of the above
+
+Usage, from within backend/src:
+
+    python bench_startup.py --runs 10
+    python bench_startup.py --path /movies --token $ASSISTANT_TOKEN
+'''
+
+PROBE = '''
+import json
+import sys
+import time
+
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+flask_app = app.create_app()
+t2 = time.perf_counter()
+headers = {'Authorization': 'Bearer ' + sys.argv[2]} if sys.argv[2] else {}
+flask_app.test_client().get(sys.argv[1], headers=headers)
+t3 = time.perf_counter()
+
+print(json.dumps({
+    'import': t1 - t0,
+    'create_app': t2 - t1,
+    'first_response': t3 - t2,
+    'total': t3 - t0
+}))
+'''
+
+
+def run_worker_boot(path, token):
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, path, token or ''],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True,
+        capture_output=True,
+        text=True).stdout
+
+    # the probe's timings are the last line, anything before it is app output
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures worker boot and first response times.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--token', default=os.environ.get('BENCH_TOKEN'))
+    args = parser.parse_args()
+
+    runs = [run_worker_boot(args.path, args.token) for _ in range(args.runs)]
+
+    print(f'{args.runs} worker boots, first request GET {args.path}')
+    print(f'{"":16}{"median ms":>12}{"max ms":>12}')
+    for phase in ('import', 'create_app', 'first_response', 'total'):
+        timings = [run[phase] * 1000 for run in runs]
+        print(f'{phase:16}{statistics.median(timings):12.1f}'
+              f'{max(timings):12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, func
+
+from .models import db, Movie, ChangeLog
+from .changes import ENTITIES, settled, settled_cutoff
+from .tenants import current_tenant
+
+'''
+Entity cache
+
+A process-level, size-bounded cache of formatted rows keyed by primary key.
+Entries are evicted when this process flushes a change to the row, and at
+most every ENTITY_CACHE_SYNC_INTERVAL seconds the cache reads the change log
+written by every other process since it last looked (see changes.py) and
+evicts whatever changed there, holding its cursor back behind recent changes
+the same way the feed does. Between syncs a hit costs no query at all. A TTL
+bounds staleness between syncs, and if a change log entry is ever missed.
+Rows are only served to requests of the tenant they belong to.
+'''
+
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 1024))
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 60))
+# seconds between reads of the change log, per process
+ENTITY_CACHE_SYNC_INTERVAL = float(
+    os.environ.get('ENTITY_CACHE_SYNC_INTERVAL', 1))
+
+
+class EntityCache:
+    def __init__(self, model, max_size=ENTITY_CACHE_SIZE,
+                 ttl=ENTITY_CACHE_TTL,
+                 sync_interval=ENTITY_CACHE_SYNC_INTERVAL):
+        self.model = model
+        self.entity = ENTITIES[model]
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        # id -> (loaded_at, tenant, formatted row)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._cursor = None  # last settled change log id seen
+        # ids of unsettled changes past the cursor that were already evicted
+        self._evicted = set()
+        self._synced_at = None  # time.monotonic() of the last sync
+        self.hits = 0
+        self.misses = 0
+
+    # get(id)
+    #   returns the formatted row with the given id, or None if it does not
+    #   exist
+    def get(self, id):
+        rows, missing = self.get_many([id])
+        return rows[0] if rows else None
+
+    # get_many(ids)
+    #   returns the formatted rows found, in the order their ids were given,
+    #   and the ids that do not exist. Misses are loaded in a single query.
+    def get_many(self, ids):
+        self.sync()
+        found = {}
+        now = time.monotonic()
+        tenant = current_tenant()
+
+        with self._lock:
+            for id in ids:
+                entry = self._entries.get(id)
+                if entry and now - entry[0] < self.ttl and \
+                        tenant in (None, entry[1]):
+                    self._entries.move_to_end(id)
+                    found[id] = entry[2]
+
+            self.hits += len(found)
+            self.misses += len(ids) - len(found)
+
+        misses = [id for id in ids if id not in found]
+        if misses:
+            loaded = {
+                row.id: (row.tenant_id, row.format()) for row in
+                self.model.query.filter(self.model.id.in_(misses))}
+            found.update({id: row for id, (_, row) in loaded.items()})
+
+            with self._lock:
+                for id, (row_tenant, row) in loaded.items():
+                    self._entries[id] = (now, row_tenant, row)
+                    self._entries.move_to_end(id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        rows = [found[id] for id in ids if id in found]
+        missing = [id for id in ids if id not in found]
+        return rows, missing
+
+    def invalidate(self, id):
+        with self._lock:
+            self._entries.pop(id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._cursor = None
+            self._evicted = set()
+            self._synced_at = None
+
+    # after_fork()
+    #   a forked worker starts with a fresh lock and an empty cache instead of
+    #   the state copied from the process it was forked from
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+
+    # sync()
+    #   evicts rows changed by other processes since the last sync. Runs at
+    #   most once per sync_interval, other calls return without a query.
+    def sync(self):
+        now = time.monotonic()
+        synced_at = self._synced_at
+        if synced_at is not None and now - synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+
+        # every tenant's changes, cached rows are shared between tenants
+        if self._cursor is None:
+            self._restart()
+            return
+
+        # only this cache's entity, and no more rows than the cache can hold
+        changes = db.session.query(
+            ChangeLog.id, ChangeLog.entity_id, ChangeLog.changed_at).filter(
+            ChangeLog.id > self._cursor,
+            ChangeLog.entity == self.entity).order_by(
+            ChangeLog.id).limit(self.max_size + 1).execution_options(
+            all_tenants=True).all()
+
+        # more changed rows than cached ones (i.e. after a bulk import or a
+        # long idle spell), starting over is cheaper than reading them all
+        if len(changes) > self.max_size:
+            self._restart()
+            return
+
+        # every change is evicted once, but the cursor only moves past settled
+        # ones, so a late commit behind them is still read next time
+        with self._lock:
+            for change_id, entity_id, changed_at in changes:
+                if change_id not in self._evicted:
+                    self._entries.pop(int(entity_id), None)
+                    self._evicted.add(change_id)
+            for change in settled(changes):
+                self._cursor = max(self._cursor, change.id)
+            self._evicted = {
+                change_id for change_id in self._evicted
+                if change_id > self._cursor}
+
+    # empties the cache and moves the cursor to the last settled change
+    def _restart(self):
+        cursor = db.session.query(func.max(ChangeLog.id)).filter(
+            ChangeLog.changed_at <= settled_cutoff()).execution_options(
+            all_tenants=True).scalar() or 0
+        with self._lock:
+            self._entries.clear()
+            self._cursor = cursor
+            self._evicted = set()
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None
+        }
+
+
+movie_cache = EntityCache(Movie)
+
+
+# evicts movies written by this process as soon as they are flushed
+def _invalidate_written(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Movie):
+            movie_cache.invalidate(obj.id)
+
+
+# drop_all() (i.e. init_db_data) restarts the change log, so cached rows and
+# the cursor are meaningless afterwards
+def _clear_all(target, connection, **kw):
+    movie_cache.clear()
+
+
+event.listen(db.session, 'after_flush', _invalidate_written)
+event.listen(db.Model.metadata, 'after_drop', _clear_all)
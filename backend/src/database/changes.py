@@ -0,0 +1,108 @@
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect
+
+from .models import db, Movie, Actor, Casting, ChangeLog, pending_deletes
+
+'''
+Change feed
+
+Every flush that inserts, updates or deletes a Movie, Actor or Casting appends
+one ChangeLog row per changed row, on the flush's own connection, so the log
+commits or rolls back together with the change itself. Consumers page through
+the log by id with get_changes() instead of re-downloading the catalog. Each
+tenant sees only its own changes.
+
+Ids are handed out when a change is flushed, not when it commits, so a
+transaction that commits late can make an older id visible after a newer
+one. Cursors are therefore never moved past a change flushed less than
+CHANGE_FEED_LAG seconds ago: no change is skipped as long as its transaction
+commits within CHANGE_FEED_LAG of its flush (and worker clocks agree), at the
+price of the feed running that far behind.
+'''
+
+# longer than any write transaction stays open, request transactions are
+# bounded by their deadline (REQUEST_DEADLINE_MAX)
+CHANGE_FEED_LAG = float(os.environ.get('CHANGE_FEED_LAG', 30))
+
+ENTITIES = {
+    Movie: 'movie',
+    Actor: 'actor',
+    Casting: 'casting'
+}
+
+changelog_table = ChangeLog.__table__
+
+
+def _entity_id(obj):
+    key = inspect(obj).mapper.primary_key_from_instance(obj)
+    return ':'.join(str(k) for k in key)
+
+
+def _change(obj, operation, changed_at):
+    return {
+        'tenant_id': obj.tenant_id,
+        'entity': ENTITIES[type(obj)],
+        'entity_id': _entity_id(obj),
+        'operation': operation,
+        'changed_at': changed_at
+    }
+
+
+# runs after the rows are written (so new rows have their ids) but before the
+# transaction is committed
+def _log_changes(session, flush_context):
+    changed_at = datetime.utcnow()
+    changes = []
+
+    for obj in session.new:
+        if type(obj) in ENTITIES:
+            changes.append(_change(obj, 'insert', changed_at))
+
+    # castings removed from their actor or movie are deletes, not updates
+    deleted = pending_deletes(session)
+    deleted_set = set(deleted)
+
+    for obj in session.dirty:
+        if type(obj) in ENTITIES and obj not in deleted_set and \
+                session.is_modified(obj):
+            changes.append(_change(obj, 'update', changed_at))
+
+    for obj in deleted:
+        if type(obj) in ENTITIES:
+            changes.append(_change(obj, 'delete', changed_at))
+
+    if changes:
+        session.connection().execute(changelog_table.insert(), changes)
+
+
+event.listen(db.session, 'after_flush', _log_changes)
+
+
+# settled_cutoff()
+#   changes flushed before this time are settled
+def settled_cutoff():
+    return datetime.utcnow() - timedelta(seconds=CHANGE_FEED_LAG)
+
+
+# settled(changes)
+#   the leading changes, in id order, flushed at least CHANGE_FEED_LAG seconds
+#   ago. A more recent one may follow an id whose transaction is still open.
+def settled(changes):
+    cutoff = settled_cutoff()
+    for i, change in enumerate(changes):
+        if change.changed_at > cutoff:
+            return changes[:i]
+    return changes
+
+
+# get_changes(since, limit)
+#   returns up to `limit` settled changes logged after the `since` cursor,
+#   oldest first, and the cursor to pass on the next call
+def get_changes(since=0, limit=100):
+    changes = settled(ChangeLog.query.filter(ChangeLog.id > since).order_by(
+        ChangeLog.id).limit(limit).all())
+
+    next_cursor = changes[-1].id if changes else since
+    return changes, next_cursor
@@ -1,7 +1,9 @@
 # Consider importing os module here
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from flask_sqlalchemy import SQLAlchemy
 import json
+from contextlib import contextmanager
+from datetime import datetime
 from .test_database_setup import MOVIES, ACTORS
 import os
 
@@ -13,9 +15,15 @@ database_path = os.environ.get('DATABASE_URL', default_path).replace(
     'postgres://', 'postgresql://')  # replacing since 'postgres' is deprecated
 db = SQLAlchemy()
 
+# tenant of rows written outside of a request, and of tokens without a tenant
+# claim (see database/tenants.py)
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
+
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. Does not touch the
+    database, the schema is created and upgraded by the migrations
+    (`python manage.py db upgrade`).
 '''
 
 
@@ -24,7 +32,31 @@ def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+# unit_of_work()
+#   wraps a request's changes in one transaction. Commits once when the block
+#   finishes, or rolls back once if it raises, so a failed request never
+#   leaves a half-flushed session behind. Model insert()/update()/delete()
+#   commit on their own and are not called inside the block. A unit of work
+#   inside another one (i.e. a route run by @idempotent) only flushes, and
+#   the outermost one commits.
+@contextmanager
+def unit_of_work():
+    if db.session.info.get('unit_of_work'):
+        yield db.session
+        db.session.flush()
+        return
+
+    db.session.info['unit_of_work'] = True
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.info.pop('unit_of_work', None)
 
 
 # init_db_data intializes databases with dummy data for testing purposes
@@ -33,9 +65,11 @@ def init_db_data():
     db.create_all()
 
     for movie in MOVIES:
+        # release dates are kept in the format the API returns them in
         new_movie = Movie(
             title=movie['title'],
-            release=movie['release']
+            release=datetime.strptime(
+                movie['release'], '%a, %d %b %Y %H:%M:%S GMT')
         )
 
         new_movie.insert()
@@ -46,23 +80,69 @@ def init_db_data():
             age=actor['age'],
             gender=actor['gender'])
 
-        new_actor.movie_id = actor['movie_id']
+        new_actor.cast_in(actor['movie_id'])
         new_actor.insert()
 
 
+# get_by_ids(model, ids)
+#   loads the rows of `model` with the given primary keys in a single
+#   'WHERE id IN (...)' query. Returns the rows found, in the order their ids
+#   were given, and the list of ids that do not exist.
+def get_by_ids(model, ids):
+    found = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+    rows = [found[i] for i in ids if i in found]
+    missing = [i for i in ids if i not in found]
+    return rows, missing
+
+
+# pending_deletes(session)
+#   the rows the next flush deletes: those passed to session.delete(), and
+#   castings removed from their actor's or movie's castings, which are deleted
+#   as orphans without ever appearing in session.deleted. Valid until the
+#   end of after_flush.
+def pending_deletes(session):
+    orphans = [obj for obj in session.dirty
+               if isinstance(obj, Casting) and _is_orphan(obj)]
+    return list(session.deleted) + orphans
+
+
+def _is_orphan(casting):
+    for parent in ('actor', 'movie'):
+        history = inspect(casting).attrs[parent].history
+        if history.deleted and not any(history.added):
+            return True
+    return False
+
+
 # MODELS
 
 
-class Movie(db.Model):
+# TenantScoped
+#   rows of models with this mixin belong to one studio. Inside a request,
+#   queries only see the current tenant's rows (see database/tenants.py).
+class TenantScoped:
+    tenant_id = db.Column(
+        db.String, nullable=False, default=DEFAULT_TENANT,
+        server_default=DEFAULT_TENANT)
+
+
+class Movie(TenantScoped, db.Model):
     __tablename__ = 'Movie'
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
     release = db.Column(db.DateTime, nullable=False)  # date Movie is released
+    # incremented on every update, an update made from a stale version fails
+    # instead of overwriting a concurrent one (optimistic concurrency)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    castings = db.relationship(
+        'Casting', back_populates='movie', cascade='all, delete-orphan')
 
-    # MAY NOT BE NECESSARY, IN FACT THIS NOT BE A RELATIONSHIP BETWEEN THE TWO
-    # CLASSES
-    actors = db.relationship('Actor', backref='movie', lazy=True)
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (
+        db.Index('ix_Movie_tenant_id_id', 'tenant_id', 'id'),
+    )
 
     def __init__(self, title, release):
         self.title = title
@@ -83,20 +163,31 @@ class Movie(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'release': self.release
+            'release': self.release,
+            'version': self.version
         }
 
 
-class Actor(db.Model):
+class Actor(TenantScoped, db.Model):
     __tablename__ = 'Actor'
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     age = db.Column(db.Integer, nullable=False)
     gender = db.Column(db.String, nullable=False)
+    # incremented on every update of the actor's own fields, see Movie.version
+    version = db.Column(db.Integer, nullable=False, default=1)
 
-    # actor could currently not be assigned to a movie, so nullable is True
-    movie_id = db.Column(db.Integer, db.ForeignKey('Movie.id'), nullable=True)
+    # castings (and their movies) are loaded for a whole batch of actors in one
+    # extra query instead of one query per actor
+    castings = db.relationship(
+        'Casting', back_populates='actor', cascade='all, delete-orphan',
+        lazy='selectin')
+
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (
+        db.Index('ix_Actor_tenant_id_id', 'tenant_id', 'id'),
+    )
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -114,14 +205,249 @@ class Actor(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    # cast_in(movie_id, role, start_date, end_date)
+    #   casts the actor in a movie, or updates the role/dates of an existing
+    #   casting. Changes are saved by the next insert()/update().
+    def cast_in(self, movie_id, role=None, start_date=None, end_date=None):
+        for casting in self.castings:
+            if casting.movie_id == movie_id:
+                casting.role = role or casting.role
+                casting.start_date = start_date or casting.start_date
+                casting.end_date = end_date or casting.end_date
+                return casting
+
+        casting = Casting(
+            tenant_id=self.tenant_id,
+            movie_id=movie_id,
+            role=role,
+            start_date=start_date,
+            end_date=end_date)
+        self.castings.append(casting)
+        return casting
+
+    # the most recent casting, used for the current_movie fields
+    def current_casting(self):
+        if not self.castings:
+            return None
+
+        return max(
+            self.castings,
+            key=lambda c: (c.start_date or datetime.min, c.movie_id or 0))
+
     def format(self):
+        current = self.current_casting()
         return {
             'id': self.id,
             'name': self.name,
             'age': self.age,
             'gender': self.gender,
-            # returns none if actor is not assigned to a movie
-            'current_movie': self.movie.title if self.movie_id else None,
-            # returns none if actor is not assigned to a movie
-            'current_movie_id': self.movie.id if self.movie_id else None
+            # returns none if actor is not cast in any movie
+            'current_movie': current.movie.title if current else None,
+            # returns none if actor is not cast in any movie
+            'current_movie_id': current.movie_id if current else None,
+            'castings': [casting.format() for casting in self.castings],
+            'version': self.version
+        }
+
+
+class Casting(TenantScoped, db.Model):
+    __tablename__ = 'Casting'
+
+    # the primary key leads on movie_id for cast lookups, the second index
+    # leads on actor_id for filmography lookups
+    movie_id = db.Column(
+        db.Integer, db.ForeignKey('Movie.id', ondelete='CASCADE'),
+        primary_key=True)
+    actor_id = db.Column(
+        db.Integer, db.ForeignKey('Actor.id', ondelete='CASCADE'),
+        primary_key=True)
+    role = db.Column(db.String, nullable=True)
+    start_date = db.Column(db.DateTime, nullable=True)
+    end_date = db.Column(db.DateTime, nullable=True)
+
+    movie = db.relationship('Movie', back_populates='castings', lazy='joined')
+    actor = db.relationship('Actor', back_populates='castings')
+
+    __table_args__ = (
+        db.Index('ix_Casting_actor_id_movie_id', 'actor_id', 'movie_id'),
+        db.Index('ix_Casting_tenant_id_movie_id', 'tenant_id', 'movie_id'),
+    )
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def update(self):
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+    def format(self):
+        return {
+            'movie_id': self.movie_id,
+            'actor_id': self.actor_id,
+            'role': self.role,
+            'start_date': self.start_date,
+            'end_date': self.end_date
+        }
+
+
+class CatalogStat(TenantScoped, db.Model):
+    __tablename__ = 'CatalogStat'
+
+    # every studio has its own counters
+    tenant_id = db.Column(
+        db.String, primary_key=True, default=DEFAULT_TENANT)
+    # counter family (i.e. 'gender', 'age_group', 'cast_size') and the bucket
+    # being counted within it (i.e. 'Female', '30-39', a movie id)
+    name = db.Column(db.String, primary_key=True)
+    key = db.Column(db.String, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'name': self.name,
+            'key': self.key,
+            'count': self.count
+        }
+
+
+class ChangeLog(TenantScoped, db.Model):
+    __tablename__ = 'ChangeLog'
+
+    # append-only, the id doubles as the cursor consumers sync from
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'),
+                   primary_key=True)
+    entity = db.Column(db.String, nullable=False)  # 'movie', 'actor', ...
+    # primary key of the changed row, 'movie_id:actor_id' for castings
+    entity_id = db.Column(db.String, nullable=False)
+    operation = db.Column(db.String, nullable=False)  # insert/update/delete
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    # each studio pages through its own changes
+    __table_args__ = (
+        db.Index('ix_ChangeLog_tenant_id_id', 'tenant_id', 'id'),
+    )
+
+    def format(self):
+        return {
+            'cursor': self.id,
+            'entity': self.entity,
+            'entity_id': self.entity_id,
+            'operation': self.operation,
+            'changed_at': self.changed_at
+        }
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'IdempotencyKey'
+
+    # keys are chosen by clients, so they are scoped to the token subject
+    subject = db.Column(db.String, primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    # hash of the method, path and body the key was first used with
+    request_hash = db.Column(db.String(64), nullable=False)
+    # the stored response, both None while the first request is in flight
+    status_code = db.Column(db.Integer, nullable=True)
+    response_body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    # expired keys are purged by expires_at
+    __table_args__ = (
+        db.Index('ix_IdempotencyKey_expires_at', 'expires_at'),
+    )
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def update(self):
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+
+class SlowQuery(db.Model):
+    __tablename__ = 'SlowQuery'
+
+    # hash of the normalized statement, see slow_queries.py
+    fingerprint = db.Column(db.String(40), primary_key=True)
+    statement = db.Column(db.Text, nullable=False)
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    total_ms = db.Column(db.Float, nullable=False, default=0)
+    max_ms = db.Column(db.Float, nullable=False, default=0)
+    # types of the bound parameters (never their values) and the routes the
+    # statement was issued from, a few recent ones of each
+    parameter_shapes = db.Column(db.JSON, nullable=True)
+    endpoints = db.Column(db.JSON, nullable=True)
+    plan = db.Column(db.Text, nullable=True)  # last sampled EXPLAIN ANALYZE
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False)
+
+    # reports read the statements with the most total time first
+    __table_args__ = (
+        db.Index('ix_SlowQuery_total_ms', 'total_ms'),
+    )
+
+    def format(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'statement': self.statement,
+            'calls': self.calls,
+            'total_ms': round(self.total_ms, 2),
+            'mean_ms': round(self.total_ms / self.calls, 2)
+            if self.calls else None,
+            'max_ms': round(self.max_ms, 2),
+            'parameter_shapes': self.parameter_shapes,
+            'endpoints': self.endpoints,
+            'plan': self.plan,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen
+        }
+
+
+class Job(TenantScoped, db.Model):
+    __tablename__ = 'Job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)  # name of the job handler
+    payload = db.Column(db.JSON, nullable=False)
+    # 'queued', 'running', 'succeeded' or 'failed'
+    status = db.Column(db.String, nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False)  # not picked up before
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    result = db.Column(db.JSON, nullable=True)
+    last_error = db.Column(db.String, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    # workers look for the next due job by status and run_at
+    __table_args__ = (
+        db.Index('ix_Job_status_run_at', 'status', 'run_at'),
+    )
+
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def update(self):
+        db.session.commit()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'result': self.result,
+            'last_error': self.last_error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
         }
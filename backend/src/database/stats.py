@@ -0,0 +1,339 @@
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+from sqlalchemy import and_, event, func, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .models import db, Movie, Actor, Casting, CatalogStat, pending_deletes
+
+'''
+Catalog statistics
+
+Counters in the CatalogStat table are kept up to date from the same flush
+that writes a Movie, Actor or Casting, so reading them never scans the catalog.
+Every tenant has its own counters. Buckets are (name, key) pairs:
+
+    ('totals', 'movies' | 'actors' | 'unassigned_actors')
+    ('gender', <gender>)
+    ('age_group', '30-39')
+    ('release_month', '2022-01')
+    ('cast_size', <movie id>)
+'''
+
+stat_table = CatalogStat.__table__
+
+# dialects with 'INSERT ... ON CONFLICT DO UPDATE'
+UPSERT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert
+}
+
+
+# age_group(age)
+#   returns the decade bucket an actor's age falls into, i.e. 36 -> '30-39'
+def age_group(age):
+    try:
+        decade = int(age) // 10 * 10
+    except (TypeError, ValueError):
+        return 'unknown'
+
+    return f'{decade}-{decade + 9}'
+
+
+# release_month(release)
+#   returns the 'YYYY-MM' bucket for a release date. Release dates may still be
+#   the raw strings sent by the client at flush time, so the formats accepted
+#   by the API are parsed here as well.
+def release_month(release):
+    if isinstance(release, str):
+        try:
+            release = parsedate_to_datetime(release)
+        except (TypeError, ValueError):
+            try:
+                release = datetime.strptime(release.strip()[:10], '%Y-%m-%d')
+            except ValueError:
+                return 'unknown'
+
+    if release is None:
+        return 'unknown'
+
+    return release.strftime('%Y-%m')
+
+
+def _actor_buckets(gender, age):
+    return [
+        ('totals', 'actors'),
+        ('gender', str(gender)),
+        ('age_group', age_group(age))
+    ]
+
+
+def _movie_buckets(release):
+    return [('totals', 'movies'), ('release_month', release_month(release))]
+
+
+# returns the value an attribute held before the pending change, or its current
+# value if it was not changed
+def _previous(obj, attr):
+    history = inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+
+    return getattr(obj, attr)
+
+
+def _add(deltas, tenant, buckets, amount):
+    for name, key in buckets:
+        bucket = (tenant, name, key)
+        deltas[bucket] = deltas.get(bucket, 0) + amount
+
+
+# collects counter deltas for every pending Movie/Actor/Casting write. Runs
+# before the flush so deleted rows can still be read.
+def _collect_deltas(session, flush_context, instances):
+    pending = {
+        'deltas': {},
+        'new_castings': [],
+        'deleted_cast_ids': [],
+        'deleted_movies': []
+    }
+
+    with session.no_autoflush:
+        _collect_into(session, pending)
+
+    session.info['catalog_stat_deltas'] = pending
+
+
+# the actor a casting belongs to, by id, read from the casting's own column so
+# the actor is never loaded. A new actor has no id yet and stands for itself.
+def _actor_key(casting):
+    actor_id = _previous(casting, 'actor_id')
+    if actor_id is not None:
+        return actor_id
+    actor = casting.actor
+    if actor is None or actor.id is None:
+        return actor
+    return actor.id
+
+
+def _collect_into(session, pending):
+    deltas = pending['deltas']
+    # net change in the number of castings of every actor touched by the
+    # flush, and the tenant of each, by _actor_key()
+    casting_changes = {}
+    actor_tenants = {}
+    new_actors = set()
+    deleted_actors = set()
+    deleted = pending_deletes(session)
+    deleted_set = set(deleted)
+
+    def change_castings(casting, amount):
+        key = _actor_key(casting)
+        if key is not None:
+            casting_changes[key] = casting_changes.get(key, 0) + amount
+            actor_tenants[key] = casting.tenant_id
+
+    for obj in session.new:
+        if isinstance(obj, Actor):
+            _add(deltas, obj.tenant_id, _actor_buckets(obj.gender, obj.age), 1)
+            key = obj if obj.id is None else obj.id
+            new_actors.add(key)
+            casting_changes.setdefault(key, 0)
+            actor_tenants[key] = obj.tenant_id
+        elif isinstance(obj, Movie):
+            _add(deltas, obj.tenant_id, _movie_buckets(obj.release), 1)
+        elif isinstance(obj, Casting):
+            pending['new_castings'].append(obj)
+            change_castings(obj, 1)
+
+    for obj in session.dirty:
+        if obj in deleted_set or not session.is_modified(obj):
+            continue
+
+        if isinstance(obj, Actor):
+            _add(deltas, obj.tenant_id, _actor_buckets(
+                _previous(obj, 'gender'), _previous(obj, 'age')), -1)
+            _add(deltas, obj.tenant_id, _actor_buckets(obj.gender, obj.age), 1)
+        elif isinstance(obj, Movie):
+            _add(deltas, obj.tenant_id, _movie_buckets(
+                _previous(obj, 'release')), -1)
+            _add(deltas, obj.tenant_id, _movie_buckets(obj.release), 1)
+
+    for obj in deleted:
+        if isinstance(obj, Actor):
+            _add(deltas, obj.tenant_id,
+                 _actor_buckets(obj.gender, obj.age), -1)
+            deleted_actors.add(obj.id)
+            casting_changes.setdefault(obj.id, 0)
+            actor_tenants[obj.id] = obj.tenant_id
+        elif isinstance(obj, Movie):
+            _add(deltas, obj.tenant_id, _movie_buckets(obj.release), -1)
+            pending['deleted_movies'].append((obj.tenant_id, str(obj.id)))
+        elif isinstance(obj, Casting):
+            pending['deleted_cast_ids'].append(
+                (obj.tenant_id, str(obj.movie_id)))
+            change_castings(obj, -1)
+
+    # castings each existing actor had before the flush, in one query
+    existing_ids = [
+        key for key in casting_changes
+        if isinstance(key, int) and key not in new_actors]
+    counts_before = {}
+    if existing_ids:
+        counts_before = dict(session.query(
+            Casting.actor_id, func.count(Casting.movie_id)).filter(
+            Casting.actor_id.in_(existing_ids)).group_by(Casting.actor_id))
+
+    # an actor is unassigned while they have no castings
+    for key, change in casting_changes.items():
+        existed_before = key not in new_actors
+        exists_after = key not in deleted_actors
+        count_before = counts_before.get(key, 0)
+        count_after = count_before + change
+
+        was_unassigned = existed_before and count_before == 0
+        is_unassigned = exists_after and count_after == 0
+        _add(deltas, actor_tenants[key], [('totals', 'unassigned_actors')],
+             int(is_unassigned) - int(was_unassigned))
+
+
+# adds `amount` to a counter, creating it if needed. Done as a single upsert
+# where the database has one, so two transactions creating the same new
+# bucket (i.e. a new release month) cannot both insert it.
+def _increment(connection, tenant, name, key, amount):
+    upsert = UPSERT_INSERTS.get(connection.dialect.name)
+    if upsert is not None:
+        connection.execute(upsert(stat_table).values(
+            tenant_id=tenant, name=name, key=key, count=amount
+        ).on_conflict_do_update(
+            index_elements=[
+                stat_table.c.tenant_id, stat_table.c.name, stat_table.c.key],
+            set_={'count': stat_table.c.count + amount}))
+        return
+
+    result = connection.execute(
+        stat_table.update()
+        .where(and_(stat_table.c.tenant_id == tenant,
+                    stat_table.c.name == name, stat_table.c.key == key))
+        .values(count=stat_table.c.count + amount))
+
+    if result.rowcount == 0:
+        connection.execute(
+            stat_table.insert(),
+            {'tenant_id': tenant, 'name': name, 'key': key, 'count': amount})
+
+
+# applies the collected deltas on the flush's own connection so the counters
+# commit or roll back together with the rows they describe
+def _apply_deltas(session, flush_context):
+    pending = session.info.pop('catalog_stat_deltas', None)
+    if pending is None:
+        return
+
+    deltas = pending['deltas']
+    # new castings only know their movie id once the flush has run
+    for casting in pending['new_castings']:
+        _add(deltas, casting.tenant_id,
+             [('cast_size', str(casting.movie_id))], 1)
+    for tenant, movie_id in pending['deleted_cast_ids']:
+        _add(deltas, tenant, [('cast_size', movie_id)], -1)
+
+    connection = session.connection()
+    for (tenant, name, key), amount in deltas.items():
+        if amount:
+            _increment(connection, tenant, name, key, amount)
+
+    for tenant, movie_id in pending['deleted_movies']:
+        connection.execute(stat_table.delete().where(and_(
+            stat_table.c.tenant_id == tenant,
+            stat_table.c.name == 'cast_size',
+            stat_table.c.key == movie_id)))
+
+
+event.listen(db.session, 'before_flush', _collect_deltas)
+event.listen(db.session, 'after_flush', _apply_deltas)
+
+
+# rebuild_stats()
+#   recomputes every tenant's counters from the Movie and Actor tables. Used to
+#   seed the counters for an existing catalog or to repair them on a schedule.
+def rebuild_stats():
+    counts = {}
+
+    def add(tenant, name, key, amount):
+        bucket = (tenant, name, key)
+        counts[bucket] = counts.get(bucket, 0) + amount
+
+    for tenant, count in db.session.query(
+            Movie.tenant_id, func.count(Movie.id)).group_by(Movie.tenant_id):
+        add(tenant, 'totals', 'movies', count)
+
+    for tenant, count in db.session.query(
+            Actor.tenant_id, func.count(Actor.id)).group_by(Actor.tenant_id):
+        add(tenant, 'totals', 'actors', count)
+
+    for tenant, release in db.session.query(Movie.tenant_id, Movie.release):
+        add(tenant, 'release_month', release_month(release), 1)
+
+    for tenant, gender, count in db.session.query(
+            Actor.tenant_id, Actor.gender, func.count(Actor.id)).group_by(
+            Actor.tenant_id, Actor.gender):
+        add(tenant, 'gender', str(gender), count)
+
+    for tenant, age, count in db.session.query(
+            Actor.tenant_id, Actor.age, func.count(Actor.id)).group_by(
+            Actor.tenant_id, Actor.age):
+        add(tenant, 'age_group', age_group(age), count)
+
+    for tenant, count in db.session.query(
+            Actor.tenant_id, func.count(Actor.id)).filter(
+            ~Actor.castings.any()).group_by(Actor.tenant_id):
+        add(tenant, 'totals', 'unassigned_actors', count)
+
+    for tenant, movie_id, count in db.session.query(
+            Casting.tenant_id, Casting.movie_id,
+            func.count(Casting.actor_id)).group_by(
+            Casting.tenant_id, Casting.movie_id):
+        add(tenant, 'cast_size', str(movie_id), count)
+
+    connection = db.session.connection()
+    connection.execute(stat_table.delete())
+    if counts:
+        connection.execute(stat_table.insert(), [
+            {'tenant_id': tenant, 'name': name, 'key': key, 'count': count}
+            for (tenant, name, key), count in counts.items()])
+    db.session.commit()
+
+
+# get_catalog_stats()
+#   returns the dashboard summary. Reads only the counter rows, never the
+#   catalog itself.
+def get_catalog_stats():
+    stats = {
+        'totals': {},
+        'gender': {},
+        'age_group': {},
+        'release_month': {}
+    }
+
+    counters = CatalogStat.query.filter(
+        CatalogStat.name != 'cast_size',
+        CatalogStat.count != 0).all()
+
+    for counter in counters:
+        stats.setdefault(counter.name, {})[counter.key] = counter.count
+
+    current_month = datetime.utcnow().strftime('%Y-%m')
+    stats['upcoming_releases'] = {
+        month: count for month, count in stats['release_month'].items()
+        if month != 'unknown' and month >= current_month}
+
+    return stats
+
+
+# get_cast_size(movie_id)
+#   returns the number of actors cast in a movie
+def get_cast_size(movie_id):
+    counter = CatalogStat.query.filter_by(
+        name='cast_size', key=str(movie_id)).first()
+    return counter.count if counter else 0
@@ -0,0 +1,85 @@
+import os
+
+from flask import has_request_context, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.orm import with_loader_criteria
+
+from .models import db, DEFAULT_TENANT, TenantScoped
+
+'''
+Tenants
+
+One deployment serves several studios. Every catalog row carries the
+tenant_id of the studio it belongs to, taken from the TENANT_CLAIM claim of
+the token that wrote it (DEFAULT_TENANT if the token has none). Inside an
+authenticated request every ORM query is limited to the current tenant's rows
+automatically, so routes never filter by tenant themselves. Outside of a
+request (migrations, manage.py commands, the job worker) queries see every
+tenant.
+
+Tenant indexes lead on tenant_id, so a studio's rows are read, exported or
+dropped with index range scans rather than scans of the whole catalog.
+'''
+
+TENANT_CLAIM = os.environ.get('TENANT_CLAIM', 'https://castingagency/tenant')
+
+# child tables first, so foreign keys hold while a tenant is dropped
+TENANT_TABLES = ['Casting', 'Actor', 'Movie', 'CatalogStat', 'ChangeLog',
+                 'Job']
+
+
+# current_tenant()
+#   the tenant of the authenticated request being served, or None outside of
+#   one
+def current_tenant():
+    if not has_request_context():
+        return None
+
+    payload = getattr(_request_ctx_stack.top, 'current_user', None)
+    if payload is None:
+        return None
+
+    return str(payload.get(TENANT_CLAIM) or DEFAULT_TENANT)
+
+
+# new rows belong to the current tenant unless one is given explicitly (i.e.
+# castings take their actor's)
+def _assign_tenant(target, args, kwargs):
+    if kwargs.get('tenant_id') is None:
+        target.tenant_id = current_tenant() or DEFAULT_TENANT
+
+
+def _scope_to_tenant(execute_state):
+    if not execute_state.is_select or execute_state.is_column_load or \
+            execute_state.is_relationship_load:
+        return
+    # i.e. the cache reading every tenant's changes
+    if execute_state.execution_options.get('all_tenants'):
+        return
+
+    tenant = current_tenant()
+    if tenant is None:
+        return
+
+    execute_state.statement = execute_state.statement.options(
+        with_loader_criteria(
+            TenantScoped,
+            lambda cls: cls.tenant_id == tenant,
+            include_aliases=True))
+
+
+event.listen(TenantScoped, 'init', _assign_tenant, propagate=True)
+event.listen(db.session, 'do_orm_execute', _scope_to_tenant)
+
+
+# drop_tenant(tenant)
+#   deletes every row that belongs to a tenant
+def drop_tenant(tenant):
+    connection = db.session.connection()
+    deleted = {}
+    for name in TENANT_TABLES:
+        table = db.Model.metadata.tables[name]
+        deleted[name] = connection.execute(
+            table.delete().where(table.c.tenant_id == tenant)).rowcount
+    db.session.commit()
+    return deleted
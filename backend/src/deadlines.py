@@ -0,0 +1,83 @@
+import os
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, text
+from werkzeug.exceptions import GatewayTimeout
+
+from database.models import db
+
+'''
+Request deadlines
+
+Every request gets a deadline when it starts: the route's budget, or the
+X-Request-Timeout header (in seconds) if the client sent a shorter or longer
+one, capped at REQUEST_DEADLINE_MAX. The time left is passed on to whatever
+the request waits on:
+
+    - each database transaction begins with SET LOCAL statement_timeout
+      (PostgreSQL only)
+    - the JWKS download uses it as its socket timeout (see auth.py)
+
+A request whose deadline has passed by the time it next waits on one of
+them, or whose query was cancelled by the statement timeout, is answered with
+a 504. Time spent queued for admission (see admission.py) counts against the
+deadline.
+'''
+
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 10))
+REQUEST_DEADLINE_MAX = float(os.environ.get('REQUEST_DEADLINE_MAX', 30))
+DEADLINE_HEADER = 'X-Request-Timeout'
+
+# PostgreSQL's SQLSTATE for a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+# remaining()
+#   seconds left until the current request's deadline, or None outside of a
+#   request. Aborts with 504 if the deadline has passed.
+def remaining():
+    if not has_request_context() or 'deadline' not in g:
+        return None
+
+    left = g.deadline - time.monotonic()
+    if left <= 0:
+        raise GatewayTimeout()
+
+    return left
+
+
+# is_deadline_error(error)
+#   whether a database error was caused by the statement timeout
+def is_deadline_error(error):
+    return getattr(getattr(error, 'orig', None), 'pgcode', None) == \
+        QUERY_CANCELED
+
+
+def _set_statement_timeout(session, transaction, connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    left = remaining()
+    if left is not None:
+        # SET does not take bind parameters, the value is always an integer
+        connection.execute(text(
+            f'SET LOCAL statement_timeout = {max(1, int(left * 1000))}'))
+
+
+event.listen(db.session, 'after_begin', _set_statement_timeout)
+
+
+# setup_deadlines(app, route_deadlines)
+#   starts the deadline of every request. route_deadlines maps endpoint names
+#   to their budget in seconds, other endpoints get REQUEST_DEADLINE.
+def setup_deadlines(app, route_deadlines):
+    @app.before_request
+    def start_deadline():
+        seconds = route_deadlines.get(request.endpoint, REQUEST_DEADLINE)
+
+        requested = request.headers.get(DEADLINE_HEADER, type=float)
+        if requested is not None and requested > 0:
+            seconds = requested
+
+        g.deadline = time.monotonic() + min(seconds, REQUEST_DEADLINE_MAX)
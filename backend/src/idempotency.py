@@ -0,0 +1,147 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import abort, current_app, make_response, request, \
+    _request_ctx_stack
+from sqlalchemy.exc import IntegrityError
+
+from database.models import db, unit_of_work, IdempotencyKey
+
+'''
+Idempotency keys
+
+A POST sent with an Idempotency-Key header is run once per key. The key is
+written to the IdempotencyKey table together with the route's response, in
+the same transaction as the route's own changes, so either both commit or
+neither does and a crash can never leave a key without its response. A
+retry with the same key and the same request gets the stored response back,
+with an Idempotent-Replayed header, without running the route again:
+
+    - the same key with a different method, path or body fails with a 422
+    - the same key while the first request is still running waits for it
+      (the key's row is locked until it commits) and gets its response
+    - a request that fails keeps nothing, its key included, so it can be
+      retried
+
+Keys are scoped to the token subject and expire after IDEMPOTENCY_KEY_TTL
+seconds. Expired keys can be reused, and are deleted by
+'python manage.py purge_idempotency_keys'.
+'''
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))
+MAX_KEY_LENGTH = 255
+
+_counts = {'replayed': 0}
+_lock = threading.Lock()
+
+
+def _count(name):
+    with _lock:
+        _counts[name] += 1
+
+
+# request_hash()
+#   fingerprint of the current request, a key may only be reused with the
+#   request it was first sent with
+def request_hash():
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}\n'.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+# reserve_key(subject, key, fingerprint)
+#   claims the key for the current request and returns None, or returns the
+#   unexpired IdempotencyKey that already holds it. The claim is flushed but
+#   not committed, it commits with the route's changes.
+def reserve_key(subject, key, fingerprint):
+    while True:
+        now = datetime.utcnow()
+        db.session.add(IdempotencyKey(
+            subject=subject,
+            key=key,
+            request_hash=fingerprint,
+            created_at=now,
+            expires_at=now + timedelta(seconds=IDEMPOTENCY_KEY_TTL)))
+        try:
+            # waits for a concurrent request holding the same key to finish
+            db.session.flush()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+
+        existing = IdempotencyKey.query.get((subject, key))
+        if existing is not None and existing.expires_at > now:
+            return existing
+
+        # expired, or purged since the insert failed, and free to reserve
+        IdempotencyKey.query.filter(
+            IdempotencyKey.subject == subject,
+            IdempotencyKey.key == key,
+            IdempotencyKey.expires_at <= now
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+
+# idempotent
+#   decorates a POST route to honour the Idempotency-Key header. Goes below
+#   @requires_auth, so the key is scoped to the verified token's subject.
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            abort(400)
+
+        user = getattr(_request_ctx_stack.top, 'current_user', None) or {}
+        subject = user.get('sub') or ''
+        fingerprint = request_hash()
+
+        existing = reserve_key(subject, key, fingerprint)
+        if existing is not None:
+            if existing.request_hash != fingerprint:
+                abort(422)
+
+            _count('replayed')
+            response = current_app.response_class(
+                existing.response_body,
+                status=existing.status_code,
+                mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        # the route's own unit of work joins this one, so its changes, the
+        # key and the response commit together, or all roll back if it raises
+        with unit_of_work():
+            response = make_response(f(*args, **kwargs))
+            if response.status_code >= 300:
+                db.session.rollback()
+                return response
+
+            stored = IdempotencyKey.query.get((subject, key))
+            stored.status_code = response.status_code
+            stored.response_body = response.get_data(as_text=True)
+
+        return response
+
+    return wrapper
+
+
+# purge_expired_keys()
+#   deletes expired keys and returns how many were deleted
+def purge_expired_keys():
+    deleted = IdempotencyKey.query.filter(
+        IdempotencyKey.expires_at <= datetime.utcnow()
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def metrics():
+    return dict(_counts)
@@ -0,0 +1,184 @@
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+from database.models import db, Movie, Casting, Job
+from logs import get_logger
+
+'''
+Background jobs
+
+Long running writes are queued as rows in the Job table and run by a worker
+process (worker.py) instead of inside the request. Workers claim jobs with
+'SELECT ... FOR UPDATE SKIP LOCKED', so any number of them can share the queue
+without an external broker. Failed jobs are retried with exponential backoff.
+'''
+
+# seconds a job waits before its first retry, doubled on every further retry
+JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', 5))
+# a running job not finished within this many seconds is assumed to belong to
+# a worker that died, and is picked up again
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 600))
+# seconds an idle worker sleeps before polling the queue again
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+# rows changed per transaction by the bulk job handlers
+JOB_CHUNK_SIZE = int(os.environ.get('JOB_CHUNK_SIZE', 500))
+
+HANDLERS = {}
+
+log = get_logger(__name__)
+
+
+# job(kind)
+#   registers the decorated function as the handler for jobs of `kind`. The
+#   handler is called with the job's payload as keyword arguments and returns
+#   a JSON serializable result.
+def job(kind):
+    def job_decorator(f):
+        HANDLERS[kind] = f
+        return f
+    return job_decorator
+
+
+# enqueue(kind, **payload)
+#   queues a job and returns it. The job runs once a worker picks it up.
+def enqueue(kind, **payload):
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown job kind: {kind}')
+
+    now = datetime.utcnow()
+    new_job = Job(
+        kind=kind,
+        payload=payload,
+        status='queued',
+        attempts=0,
+        run_at=now,
+        created_at=now)
+    new_job.insert()
+    return new_job
+
+
+# claim_job()
+#   marks the next due job as running and returns it, or None if no job is
+#   due. Jobs locked by another worker are skipped rather than waited on.
+def claim_job():
+    now = datetime.utcnow()
+    next_job = Job.query.filter(or_(
+        and_(Job.status == 'queued', Job.run_at <= now),
+        and_(Job.status == 'running',
+             Job.started_at < now - timedelta(seconds=JOB_LEASE_SECONDS))
+    )).order_by(Job.run_at).with_for_update(skip_locked=True).first()
+
+    if not next_job:
+        db.session.commit()
+        return None
+
+    next_job.status = 'running'
+    next_job.attempts += 1
+    next_job.started_at = now
+    next_job.update()
+    return next_job
+
+
+# run_job(claimed_job)
+#   runs a claimed job and records its result. On failure the job is queued
+#   again after a backoff until it runs out of attempts.
+def run_job(claimed_job):
+    try:
+        result = HANDLERS[claimed_job.kind](**claimed_job.payload)
+    except Exception as e:
+        db.session.rollback()
+        log.exception('job failed', extra={
+            'job_id': claimed_job.id, 'kind': claimed_job.kind})
+
+        claimed_job.last_error = str(e)
+        if claimed_job.attempts >= claimed_job.max_attempts:
+            claimed_job.status = 'failed'
+            claimed_job.finished_at = datetime.utcnow()
+        else:
+            backoff = JOB_RETRY_BACKOFF * 2 ** (claimed_job.attempts - 1)
+            claimed_job.status = 'queued'
+            claimed_job.run_at = datetime.utcnow() + timedelta(seconds=backoff)
+        claimed_job.update()
+        return
+
+    claimed_job.status = 'succeeded'
+    claimed_job.result = result
+    claimed_job.last_error = None
+    claimed_job.finished_at = datetime.utcnow()
+    claimed_job.update()
+
+
+# run_worker(max_jobs)
+#   claims and runs jobs until `max_jobs` have run, or forever if it is None.
+#   Must be called inside an app context.
+def run_worker(max_jobs=None):
+    log.info('job worker started', extra={
+        'host': socket.gethostname(), 'pid': os.getpid()})
+    jobs_run = 0
+
+    while max_jobs is None or jobs_run < max_jobs:
+        claimed_job = claim_job()
+
+        if not claimed_job:
+            db.session.remove()
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        run_job(claimed_job)
+        jobs_run += 1
+
+
+# JOB HANDLERS
+
+
+@job('delete_movie')
+def delete_movie(movie_id):
+    movie = Movie.query.get(movie_id)
+    if not movie:
+        return {'deleted_movie_id': None}
+
+    # uncasts the actors a chunk at a time so no single transaction holds
+    # locks on the whole cast
+    while True:
+        castings = Casting.query.filter(
+            Casting.movie_id == movie_id).limit(JOB_CHUNK_SIZE).all()
+        if not castings:
+            break
+
+        for casting in castings:
+            db.session.delete(casting)
+        db.session.commit()
+
+    movie.delete()
+    return {'deleted_movie_id': movie_id}
+
+
+@job('reassign_cast')
+def reassign_cast(movie_id, to_movie_id, role=None):
+    if movie_id == to_movie_id:
+        return {'movie_id': movie_id, 'to_movie_id': to_movie_id,
+                'reassigned_actors': 0}
+
+    if not Movie.query.get(to_movie_id):
+        raise ValueError(f'Movie {to_movie_id} does not exist')
+
+    reassigned = 0
+    while True:
+        castings = Casting.query.filter(
+            Casting.movie_id == movie_id).limit(JOB_CHUNK_SIZE).all()
+        if not castings:
+            break
+
+        for casting in castings:
+            actor = casting.actor
+            actor.cast_in(to_movie_id, role=role or casting.role)
+            db.session.delete(casting)
+        db.session.commit()
+        reassigned += len(castings)
+
+    return {'movie_id': movie_id, 'to_movie_id': to_movie_id,
+            'reassigned_actors': reassigned}
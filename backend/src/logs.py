@@ -0,0 +1,192 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+'''
+Structured logging
+
+Log records are handed to a bounded in-memory queue on the request thread and
+written to stdout as JSON lines by a background thread, so logging never
+blocks a request on I/O. Records logged during a request carry its request
+id, method and route. Records are dropped, and counted, if the writer falls
+behind and the queue fills up.
+
+    from logs import get_logger
+    log = get_logger(__name__)
+    log.warning('movie not created', extra={'movie_title': title})
+'''
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# logs one line per request with its status and duration
+LOG_REQUESTS = os.environ.get('LOG_REQUESTS', 'true') == 'true'
+
+ROOT_LOGGER = 'castingagency'
+
+# attributes every LogRecord has, anything else was passed in `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime'}
+
+_state = {'listener': None, 'dropped': 0}
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update({
+            key: value for key, value in vars(record).items()
+            if key not in _RECORD_ATTRS})
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+# adds the current request's fields to a record. Runs on the request thread,
+# before the record is queued, while the request context is still available.
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule else None
+        return True
+
+
+# a QueueHandler that drops records instead of blocking when the queue is full
+class DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _state['dropped'] += 1
+
+    def prepare(self, record):
+        # exceptions are formatted by the writer thread, only the message
+        # arguments need resolving here
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+# LogSampler(burst, every, window)
+#   limits high volume log lines, i.e. auth failures during an outage. The
+#   first `burst` occurrences of a key in each `window` seconds are logged,
+#   after that only every `every`th one is.
+class LogSampler:
+    def __init__(self, burst=10, every=100, window=60):
+        self.burst = burst
+        self.every = every
+        self.window = window
+        self._counts = {}  # key -> (window start, occurrences)
+        self._lock = threading.Lock()
+
+    # should_log(key)
+    #   returns whether this occurrence should be logged, and how many
+    #   occurrences of `key` in the window it stands for
+    def should_log(self, key):
+        now = time.monotonic()
+        with self._lock:
+            start, count = self._counts.get(key, (now, 0))
+            if now - start >= self.window:
+                start, count = now, 0
+            count += 1
+            self._counts[key] = (start, count)
+
+        if count <= self.burst:
+            return True, 1
+        if (count - self.burst) % self.every == 0:
+            return True, self.every
+        return False, 0
+
+
+def get_logger(name):
+    if name == ROOT_LOGGER or name.startswith(ROOT_LOGGER + '.'):
+        return logging.getLogger(name)
+
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
+
+
+def _start_listener():
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JSONFormatter())
+    listener = QueueListener(
+        _log_queue, stream_handler, respect_handler_level=False)
+    listener.start()
+    _state['listener'] = listener
+    # writes out whatever is still queued when the process exits
+    atexit.register(listener.stop)
+
+
+# setup_logging(app)
+#   routes the app's loggers through the queue and logs one line per request.
+#   Safe to call for every app that is created.
+def setup_logging(app):
+    logger = logging.getLogger(ROOT_LOGGER)
+
+    if _state['listener'] is None:
+        handler = DroppingQueueHandler(_log_queue)
+        handler.addFilter(RequestContextFilter())
+        logger.addHandler(handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+        _start_listener()
+
+    request_log = get_logger('request')
+
+    @app.before_request
+    def start_request():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def finish_request(response):
+        response.headers['X-Request-ID'] = g.get('request_id', '')
+
+        if LOG_REQUESTS and 'request_started' in g:
+            request_log.info('request', extra={
+                'status': response.status_code,
+                'duration_ms': round(
+                    (time.perf_counter() - g.request_started) * 1000, 2)})
+        return response
+
+
+# restart_after_fork()
+#   the writer thread does not survive a fork, a worker forked from a master
+#   that already logged starts its own
+def restart_after_fork():
+    global _log_queue
+
+    if _state['listener'] is None:
+        return
+
+    _log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    for handler in logging.getLogger(ROOT_LOGGER).handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            handler.queue = _log_queue
+    _start_listener()
+
+
+def metrics():
+    return {
+        'queued': _log_queue.qsize(),
+        'dropped': _state['dropped']
+    }
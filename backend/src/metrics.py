@@ -0,0 +1,18 @@
+'''
+Metrics
+
+Components register a function returning a dict of their current counters,
+and GET /metrics reports all of them together.
+'''
+
+_providers = {}
+
+
+# register_metrics(name, provider)
+#   adds the dict returned by provider() to /metrics under `name`
+def register_metrics(name, provider):
+    _providers[name] = provider
+
+
+def collect_metrics():
+    return {name: provider() for name, provider in _providers.items()}
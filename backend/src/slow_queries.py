@@ -0,0 +1,269 @@
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import case, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+from database.models import db, SlowQuery
+from logs import get_logger
+
+'''
+Slow query log
+
+Opt-in (SLOW_QUERY_LOG=true). Every statement that takes SLOW_QUERY_MS or
+longer is recorded against its normalized text, with the types of its bound
+parameters (never their values) and the route that issued it. On PostgreSQL
+the first slow run of a SELECT, and a SLOW_QUERY_EXPLAIN_RATE sample of later
+ones, are run again under EXPLAIN (ANALYZE, BUFFERS) to capture their plan.
+
+Each worker process aggregates in memory and adds its totals to the
+SlowQuery table every SLOW_QUERY_FLUSH_INTERVAL seconds, so reports cover
+every process:
+
+    GET /admin/slow-queries
+    python manage.py slow_queries --limit 20
+'''
+
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'false') == 'true'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+# share of later slow runs of a statement whose plan is captured again
+SLOW_QUERY_EXPLAIN_RATE = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.01))
+SLOW_QUERY_FLUSH_INTERVAL = float(
+    os.environ.get('SLOW_QUERY_FLUSH_INTERVAL', 60))
+# distinct parameter shapes and routes kept per statement
+MAX_SAMPLES = 5
+
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+# 'IN (?, ?, ?)' of any length is the same statement
+_PLACEHOLDER_LIST = re.compile(
+    r'\(\s*' + _PLACEHOLDER + r'(?:\s*,\s*' + _PLACEHOLDER + r')+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+log = get_logger(__name__)
+slow_query_table = SlowQuery.__table__
+
+
+# normalize(statement)
+#   the statement with placeholder lists collapsed and whitespace squeezed
+def normalize(statement):
+    return _WHITESPACE.sub(
+        ' ', _PLACEHOLDER_LIST.sub('(...)', statement)).strip()
+
+
+# parameter_shape(parameters, executemany)
+#   the types of the bound parameters, i.e. 'int x3, str'
+def parameter_shape(parameters, executemany=False):
+    prefix = ''
+    if executemany:
+        prefix = f'{len(parameters)} rows of '
+        parameters = parameters[0] if parameters else ()
+
+    if isinstance(parameters, dict):
+        parameters = parameters.values()
+
+    counts = {}
+    for value in parameters or ():
+        name = type(value).__name__
+        counts[name] = counts.get(name, 0) + 1
+
+    return prefix + ', '.join(
+        f'{name} x{count}' if count > 1 else name
+        for name, count in sorted(counts.items()))
+
+
+def _add_sample(samples, sample):
+    if sample is not None and sample not in samples:
+        samples.append(sample)
+        del samples[:-MAX_SAMPLES]
+
+
+# explain(connection, statement, parameters)
+#   runs the statement again under EXPLAIN (ANALYZE, BUFFERS) and returns the
+#   plan, or None if that fails. Runs inside a savepoint on the connection's
+#   own transaction, so a failure does not abort the transaction.
+def explain(connection, statement, parameters):
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(
+                'EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return plan
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            log.warning('slow query not explained', exc_info=True)
+            return None
+    finally:
+        cursor.close()
+
+
+class SlowQueryRecorder:
+    def __init__(self):
+        self._pending = {}  # fingerprint -> totals since the last flush
+        self._explained = set()  # fingerprints explained by this process
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_flush = time.monotonic()
+        self.captured = 0
+        self.explained = 0
+
+    # recording() is False while the recorder runs its own queries
+    def recording(self):
+        return not getattr(self._local, 'busy', False)
+
+    def record(self, connection, statement, parameters, executemany,
+               elapsed_ms):
+        normalized = normalize(statement)
+        fingerprint = hashlib.sha1(normalized.encode()).hexdigest()
+
+        plan = None
+        if connection.dialect.name == 'postgresql' and not executemany and \
+                normalized.upper().startswith('SELECT') and (
+                fingerprint not in self._explained or
+                random.random() < SLOW_QUERY_EXPLAIN_RATE):
+            self._explained.add(fingerprint)
+            plan = explain(connection, statement, parameters)
+            self.explained += plan is not None
+
+        endpoint = request.endpoint if has_request_context() else None
+        with self._lock:
+            self.captured += 1
+            entry = self._pending.setdefault(fingerprint, {
+                'statement': normalized,
+                'calls': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'parameter_shapes': [],
+                'endpoints': [],
+                'plan': None
+            })
+            entry['calls'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            _add_sample(entry['parameter_shapes'],
+                        parameter_shape(parameters, executemany))
+            _add_sample(entry['endpoints'], endpoint)
+            entry['plan'] = plan or entry['plan']
+
+    def flush_due(self):
+        return time.monotonic() - self._last_flush >= \
+            SLOW_QUERY_FLUSH_INTERVAL
+
+    # flush()
+    #   adds the totals recorded since the last flush to the SlowQuery table.
+    #   Must be called inside an app context.
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+
+        self._local.busy = True
+        try:
+            for fingerprint, entry in pending.items():
+                _save(fingerprint, entry)
+        except Exception:
+            log.exception('slow queries not saved')
+        finally:
+            self._local.busy = False
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._explained = set()
+
+    def metrics(self):
+        return {
+            'enabled': SLOW_QUERY_LOG,
+            'captured': self.captured,
+            'explained': self.explained,
+            'pending': len(self._pending)
+        }
+
+
+# adds one statement's totals, in its own transaction outside the request's
+def _save(fingerprint, entry):
+    now = datetime.utcnow()
+    c = slow_query_table.c
+    changes = {
+        'calls': c.calls + entry['calls'],
+        'total_ms': c.total_ms + entry['total_ms'],
+        'max_ms': case(
+            [(c.max_ms < entry['max_ms'], entry['max_ms'])],
+            else_=c.max_ms),
+        'parameter_shapes': entry['parameter_shapes'],
+        'endpoints': entry['endpoints'],
+        'last_seen': now
+    }
+    if entry['plan']:
+        changes['plan'] = entry['plan']
+
+    # a second attempt if another process inserts the row in between
+    for attempt in range(2):
+        with db.engine.begin() as connection:
+            if connection.execute(slow_query_table.update().where(
+                    c.fingerprint == fingerprint).values(changes)).rowcount:
+                return
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(slow_query_table.insert(), dict(
+                    entry, fingerprint=fingerprint,
+                    first_seen=now, last_seen=now))
+            return
+        except IntegrityError:
+            continue
+
+
+recorder = SlowQueryRecorder()
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    context._slow_query_started = time.perf_counter()
+
+
+def _check_duration(conn, cursor, statement, parameters, context,
+                    executemany):
+    started = getattr(context, '_slow_query_started', None)
+    if started is None or not recorder.recording():
+        return
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms >= SLOW_QUERY_MS:
+        recorder.record(conn, statement, parameters, executemany, elapsed_ms)
+
+
+# setup_slow_query_log(app)
+#   times every statement if SLOW_QUERY_LOG is on, and saves the recorded
+#   totals at the end of a request once SLOW_QUERY_FLUSH_INTERVAL has passed
+def setup_slow_query_log(app):
+    if not SLOW_QUERY_LOG:
+        return
+
+    if not event.contains(Engine, 'after_cursor_execute', _check_duration):
+        event.listen(Engine, 'before_cursor_execute', _start_timer)
+        event.listen(Engine, 'after_cursor_execute', _check_duration)
+
+    @app.teardown_request
+    def flush_slow_queries(exception):
+        if recorder.flush_due():
+            recorder.flush()
+
+
+# top_slow_queries(limit)
+#   the statements with the most total time, across every process
+def top_slow_queries(limit=20):
+    if SLOW_QUERY_LOG:
+        recorder.flush()
+
+    return SlowQuery.query.order_by(
+        SlowQuery.total_ms.desc()).limit(limit).all()
@@ -0,0 +1,160 @@
+import os
+
+from sqlalchemy import select
+
+from database.models import Movie, Actor, Casting, db
+
+'''
+Catalog snapshots
+
+Writes the catalog tables to columnar files for analytics, as Parquet or as
+Arrow IPC files:
+
+    movies      one row per movie
+    actors      one row per actor
+    cast        one row per casting, joined with its movie and actor
+
+Rows are streamed from a server-side cursor (PostgreSQL) and written
+SNAPSHOT_CHUNK_SIZE rows at a time as Arrow record batches, so memory use
+does not grow with the size of the catalog. Requires pyarrow, which is not
+installed by default (`pip install pyarrow`).
+'''
+
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get('SNAPSHOT_CHUNK_SIZE', 50000))
+# parquet compression codec, 'none' to turn compression off
+SNAPSHOT_COMPRESSION = os.environ.get('SNAPSHOT_COMPRESSION', 'zstd')
+
+# file extension and mimetype per format
+SNAPSHOT_FORMATS = {
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file')
+}
+
+movie_table = Movie.__table__
+actor_table = Actor.__table__
+casting_table = Casting.__table__
+
+
+# each snapshot is a query and the arrow type of each column it selects
+def _movies_query():
+    m = movie_table.c
+    return select([m.tenant_id, m.id, m.title, m.release]).order_by(
+        m.tenant_id, m.id), [
+        ('tenant_id', 'string'), ('id', 'int64'), ('title', 'string'),
+        ('release', 'timestamp[us]')]
+
+
+def _actors_query():
+    a = actor_table.c
+    return select([a.tenant_id, a.id, a.name, a.age, a.gender]).order_by(
+        a.tenant_id, a.id), [
+        ('tenant_id', 'string'), ('id', 'int64'), ('name', 'string'),
+        ('age', 'int32'), ('gender', 'string')]
+
+
+def _cast_query():
+    c, m, a = casting_table.c, movie_table.c, actor_table.c
+    return select([
+        c.tenant_id, c.movie_id, m.title, m.release, c.actor_id, a.name,
+        a.age, a.gender, c.role, c.start_date, c.end_date
+    ]).select_from(
+        casting_table
+        .join(movie_table, c.movie_id == m.id)
+        .join(actor_table, c.actor_id == a.id)
+    ).order_by(c.tenant_id, c.movie_id, c.actor_id), [
+        ('tenant_id', 'string'), ('movie_id', 'int64'), ('title', 'string'),
+        ('release', 'timestamp[us]'), ('actor_id', 'int64'),
+        ('name', 'string'), ('age', 'int32'), ('gender', 'string'),
+        ('role', 'string'), ('start_date', 'timestamp[us]'),
+        ('end_date', 'timestamp[us]')]
+
+
+SNAPSHOTS = {
+    'movies': _movies_query,
+    'actors': _actors_query,
+    'cast': _cast_query
+}
+
+
+# arrow_available()
+#   whether pyarrow is installed
+def arrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _open_writer(sink, schema, file_format):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if file_format == 'arrow':
+        writer = pa.ipc.new_file(sink, schema)
+        return writer.write_batch, writer.close
+
+    writer = pq.ParquetWriter(
+        sink, schema,
+        compression=None if SNAPSHOT_COMPRESSION == 'none'
+        else SNAPSHOT_COMPRESSION)
+    return (lambda batch: writer.write_table(pa.Table.from_batches([batch])),
+            writer.close)
+
+
+# write_snapshot(name, sink, file_format, tenant, chunk_size)
+#   writes one snapshot to `sink` (a path or a binary file) and returns the
+#   number of rows written. Only the tenant's rows are written if one is given.
+def write_snapshot(name, sink, file_format='parquet', tenant=None,
+                   chunk_size=SNAPSHOT_CHUNK_SIZE):
+    import pyarrow as pa
+
+    query, columns = SNAPSHOTS[name]()
+    if tenant is not None:
+        query = query.where(query.selected_columns.tenant_id == tenant)
+    schema = pa.schema([
+        (column, pa.type_for_alias(arrow_type))
+        for column, arrow_type in columns])
+
+    # stream_results fetches through a server-side cursor, chunk by chunk,
+    # instead of loading the whole result into memory
+    result = db.session.connection().execution_options(
+        stream_results=True).execute(query)
+
+    write_batch, close = _open_writer(sink, schema, file_format)
+    rows = 0
+    try:
+        while True:
+            chunk = result.fetchmany(chunk_size)
+            if not chunk:
+                break
+
+            write_batch(pa.RecordBatch.from_arrays([
+                pa.array(values, type=field.type)
+                for values, field in zip(zip(*chunk), schema)
+            ], schema=schema))
+            rows += len(chunk)
+    finally:
+        close()
+        result.close()
+
+    return rows
+
+
+# write_snapshots(directory, file_format, tenant)
+#   writes every snapshot to a file in `directory`. Returns the path, row
+#   count and size in bytes of each.
+def write_snapshots(directory, file_format='parquet', tenant=None):
+    os.makedirs(directory, exist_ok=True)
+    extension = SNAPSHOT_FORMATS[file_format][0]
+
+    written = {}
+    for name in SNAPSHOTS:
+        path = os.path.join(directory, f'{name}.{extension}')
+        rows = write_snapshot(name, path, file_format, tenant)
+        written[name] = {
+            'path': path,
+            'rows': rows,
+            'bytes': os.path.getsize(path)
+        }
+    return written
@@ -1,10 +1,17 @@
 import os
 import unittest
 import json
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 from app import create_app
-from database.models import setup_db, init_db_data, Movie, Actor
+from database.models import setup_db, init_db_data, Movie, Actor, Casting
+from jobs import run_worker
+from admission import setup_admission_control
+from snapshots import arrow_available
 
 
 class CastingAgencyTestCase(unittest.TestCase):
@@ -80,6 +87,20 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data['movies'])
         self.assertTrue(data['total_num_movies'])
 
+    # tests get_movies() in app.py when fetching a batch of ids
+    def test_get_movies_by_ids(self):
+        res = self.client().get(
+            '/movies?ids=2,5000,1',
+            headers={
+                'Authorization': f'Bearer {self.assistant}'})
+
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([m['id'] for m in data['movies']], [2, 1])
+        self.assertEqual(data['missing_ids'], [5000])
+
     # tests get_actors() in app.py
     def test_get_actors(self):
         res = self.client().get(
@@ -109,6 +130,86 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['new_movie_id'])
 
+    # tests that a retried create_movie() with the same Idempotency-Key
+    # returns the first response without creating a second movie
+    def test_create_movie_idempotency_key(self):
+        headers = {
+            'Authorization': f'Bearer {self.producer}',
+            'Content-Type': 'application/json',
+            'Idempotency-Key': 'create-movie-retry'}
+        movies = Movie.query.count()
+
+        first = self.client().post('/movies', headers=headers, json=self.movie)
+        retry = self.client().post('/movies', headers=headers, json=self.movie)
+        changed = self.client().post(
+            '/movies', headers=headers, json=dict(self.movie, title='Other'))
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(
+            json.loads(retry.data)['new_movie_id'],
+            json.loads(first.data)['new_movie_id'])
+        self.assertEqual(changed.status_code, 422)
+        self.assertEqual(Movie.query.count(), movies + 1)
+
+    # tests that movies of another tenant are not visible, the test tokens
+    # carry no tenant claim and belong to the default tenant
+    def test_get_movies_hides_other_tenants(self):
+        with self.app.app_context():
+            movie = Movie(title='Other Studio', release='2022-01-01')
+            movie.tenant_id = 'other-studio'
+            movie.insert()
+            movie_id = movie.id
+
+        res = self.client().get(
+            f'/movies?ids=1,{movie_id}',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['id'] for m in data['movies']], [1])
+        self.assertEqual(data['missing_ids'], [movie_id])
+
+        res = self.client().patch(
+            f'/movies/{movie_id}',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json={'title': 'Taken Over'})
+        self.assertEqual(res.status_code, 404)
+
+    @unittest.skipUnless(arrow_available(), 'pyarrow is not installed')
+    def test_get_snapshot(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        res = self.client().get(
+            '/admin/snapshots/cast',
+            headers={'Authorization': f'Bearer {self.producer}'})
+
+        self.assertEqual(res.status_code, 200)
+        table = pq.read_table(pa.BufferReader(res.data))
+        self.assertEqual(table.num_rows, Casting.query.count())
+        self.assertIn('title', table.column_names)
+
+    def test_get_slow_queries(self):
+        res = self.client().get(
+            '/admin/slow-queries?limit=5',
+            headers={'Authorization': f'Bearer {self.producer}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertLessEqual(len(data['slow_queries']), 5)
+
+    def test_403_get_slow_queries_without_admin(self):
+        res = self.client().get(
+            '/admin/slow-queries',
+            headers={'Authorization': f'Bearer {self.director}'})
+
+        self.assertEqual(res.status_code, 403)
+
     # tests failure for create_movie when 'title' field is missing
     def test_422_if_create_movie_unprocessable(self):
         res = self.client().post(
@@ -123,6 +224,36 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['error'], 422)
         self.assertEqual(data['message'], 'unprocessable')
 
+    # tests that create_movie() rejects a malformed release date before it
+    # reaches the database, naming the field
+    def test_422_if_create_movie_release_invalid(self):
+        movies = Movie.query.count()
+        res = self.client().post(
+            '/movies',
+            headers={
+                'Authorization': f'Bearer {self.producer}',
+                'Content-Type': 'application/json'},
+            json=dict(self.movie, release=self.movie_bad['release']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['message'], 'unprocessable')
+        self.assertIn('release', data['errors'])
+        self.assertEqual(Movie.query.count(), movies)
+
+    # tests that add_actor() rejects a movie_id that does not exist
+    def test_422_if_add_actor_movie_missing(self):
+        res = self.client().post(
+            '/actors',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json=dict(self.actor, movie_id=1000))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {'movie_id': 'no movie with id 1000'})
+
     def test_add_actor(self):
         res = self.client().post(
             '/actors',
@@ -137,6 +268,37 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['new_actor_id'])
 
+    def test_add_actors_in_bulk(self):
+        actors = Actor.query.count()
+        res = self.client().post(
+            '/actors',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json=[self.actor, dict(self.actor, movie_id=2)])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['new_actor_ids']), 2)
+        self.assertEqual(Actor.query.count(), actors + 2)
+
+    # nothing is added if any actor in the list is invalid, and errors are
+    # reported by the actor's index
+    def test_422_if_bulk_actor_invalid(self):
+        actors = Actor.query.count()
+        res = self.client().post(
+            '/actors',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json=[self.actor, dict(self.actor, movie_id=1000)])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(
+            data['errors'], {'1': {'movie_id': 'no movie with id 1000'}})
+        self.assertEqual(Actor.query.count(), actors)
+
     def test_422_if_add_actor_unprocessable(self):
         res = self.client().post(
             '/actors',
@@ -168,6 +330,27 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['updated_movie']['title'], 'Untitled')
 
+    # tests update_movie() with an If-Match header from before another update
+    def test_412_if_stale_version_update_movie(self):
+        version = Movie.query.get(2).version
+        headers = {
+            'Authorization': f'Bearer {self.director}',
+            'Content-Type': 'application/json',
+            'If-Match': f'"{version}"'}
+
+        first = self.client().patch(
+            '/movies/2', headers=headers, json={'title': 'First'})
+        res = self.client().patch(
+            '/movies/2', headers=headers, json={'title': 'Second'})
+
+        data = json.loads(res.data)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers['ETag'], f'"{version + 1}"')
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['message'], 'precondition failed')
+        self.assertEqual(Movie.query.get(2).title, 'First')
+
     # tests update_movie() if no json payload is provided
     def test_400_if_bad_request_update_movie(self):
         res = self.client().patch(
@@ -227,6 +410,29 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['deleted_movie_id'], 3)
 
+    def test_delete_movie_in_background_job(self):
+        res = self.client().delete(
+            '/movies/1?async=true',
+            headers={
+                'Authorization': f'Bearer {self.producer}'})
+
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['status'], 'queued')
+
+        run_worker(max_jobs=1)
+
+        res = self.client().get(
+            res.headers['Location'],
+            headers={
+                'Authorization': f'Bearer {self.producer}'})
+
+        data = json.loads(res.data)
+
+        self.assertEqual(data['job']['status'], 'succeeded')
+        self.assertEqual(Movie.query.get(1), None)
+
     def test_404_if_movie_not_found(self):
         res = self.client().delete(
             '/movies/5000',
@@ -286,6 +492,227 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['error'], 404)
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_get_casts_for_movies(self):
+        res = self.client().get(
+            '/movies/casts?ids=1,2,3',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['casts']['1']), 2)
+        self.assertEqual(len(data['casts']['2']), 1)
+        self.assertEqual(data['casts']['3'], [])
+
+    def test_get_casts_for_movies_query_count(self):
+        selects = []
+
+        def count_select(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith('SELECT'):
+                selects.append(statement)
+
+        # the actors, then their castings, however many there are
+        event.listen(Engine, 'before_cursor_execute', count_select)
+        try:
+            res = self.client().get(
+                '/movies/casts?ids=1,2,3',
+                headers={'Authorization': f'Bearer {self.assistant}'})
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count_select)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(selects), 2)
+
+    def test_400_if_casts_ids_malformed(self):
+        res = self.client().get(
+            '/movies/casts?ids=1,two',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['error'], 400)
+
+    def test_cast_actor_in_second_movie(self):
+        res = self.client().post(
+            '/movies/3/actors',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json={'actor_id': 1, 'role': 'Lead'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        res = self.client().get(
+            '/actors/filmographies?ids=1',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            sorted(c['movie_id'] for c in data['filmographies']['1']), [1, 3])
+
+    def test_422_if_casting_unprocessable(self):
+        res = self.client().post(
+            '/movies/3/actors',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json={'actor_id': 'one', 'start_date': '2040 - 05 - 05'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], {
+            'actor_id': 'expected an integer',
+            'start_date': 'expected a date, i.e. 2022-01-31'})
+
+    @mock.patch('database.changes.CHANGE_FEED_LAG', 0)
+    def test_get_changes_after_delete(self):
+        res = self.client().get(
+            '/changes?since=0&limit=1000',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        cursor = json.loads(res.data)['next_cursor']
+
+        self.client().delete(
+            '/actors/3',
+            headers={'Authorization': f'Bearer {self.director}'})
+
+        res = self.client().get(
+            f'/changes?since={cursor}',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn(
+            {'entity': 'actor', 'entity_id': '3', 'operation': 'delete'},
+            [{k: c[k] for k in ('entity', 'entity_id', 'operation')}
+             for c in data['changes']])
+
+    def test_changes_held_back_behind_recent_flushes(self):
+        res = self.client().get(
+            '/changes?since=0&limit=1000',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        # the test data was just written, so none of it has settled yet
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['changes'], [])
+        self.assertEqual(data['next_cursor'], 0)
+
+    def test_movie_cache_follows_updates(self):
+        headers = {'Authorization': f'Bearer {self.assistant}'}
+        self.client().get('/movies?ids=2', headers=headers)
+
+        self.client().patch(
+            '/movies/2',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json={'title': 'Untitled'})
+
+        res = self.client().get('/movies?ids=2', headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['movies'][0]['title'], 'Untitled')
+
+        res = self.client().get('/metrics')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('hit_rate', data['metrics']['movie_cache'])
+
+    def test_get_stats(self):
+        res = self.client().get(
+            '/stats',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['stats']['totals']['movies'], 3)
+        self.assertEqual(data['stats']['totals']['actors'], 3)
+        self.assertEqual(data['stats']['gender']['Female'], 2)
+
+    def test_stats_follow_actor_writes(self):
+        self.client().post(
+            '/actors',
+            headers={
+                'Authorization': f'Bearer {self.director}',
+                'Content-Type': 'application/json'},
+            json=self.actor)
+
+        res = self.client().get(
+            '/stats/movies/1',
+            headers={'Authorization': f'Bearer {self.assistant}'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['cast_size'], 3)
+
+    # the app runs under threaded gunicorn workers, requests on several
+    # threads at once must not share sessions or corrupt the movie cache
+    def test_concurrent_requests(self):
+        def get(path):
+            res = self.client().get(
+                path,
+                headers={'Authorization': f'Bearer {self.assistant}'})
+            return res.status_code, json.loads(res.data)
+
+        paths = ['/movies?ids=1,2,3', '/actors', '/movies/1/actors'] * 8
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(get, paths))
+
+        for status_code, data in results:
+            self.assertEqual(status_code, 200)
+            self.assertEqual(data['success'], True)
+
+    def test_request_id_is_returned(self):
+        res = self.client().get('/', headers={'X-Request-ID': 'abc123'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Request-ID'], 'abc123')
+
+    def test_503_if_route_over_capacity(self):
+        # no slots and no queue, every request to the route is shed
+        setup_admission_control(self.app, {'welcome': (0, 0)})
+        res = self.client().get('/')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['error'], 503)
+        self.assertEqual(data['message'], 'service unavailable')
+        self.assertTrue(res.headers['Retry-After'])
+
+    def test_504_if_deadline_exceeded(self):
+        res = self.client().get(
+            '/actors',
+            headers={
+                'Authorization': f'Bearer {self.assistant}',
+                'X-Request-Timeout': '0.000001'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertEqual(data['error'], 504)
+        self.assertEqual(data['message'], 'request deadline exceeded')
+
+    # a write route answers a passed deadline with 504, not 422, and keeps
+    # nothing
+    def test_504_if_deadline_exceeded_on_write(self):
+        movies = Movie.query.count()
+        res = self.client().post(
+            '/movies',
+            headers={
+                'Authorization': f'Bearer {self.producer}',
+                'Content-Type': 'application/json',
+                'X-Request-Timeout': '0.000001'},
+            json=self.movie)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertEqual(data['error'], 504)
+        self.assertEqual(Movie.query.count(), movies)
+
     # tests for RBAC:
 
     # tests for assistant role, should test for failure
@@ -354,6 +781,19 @@ class CastingAgencyTestCase(unittest.TestCase):
             data['message']['description'],
             'Access Forbidden. User not allowed to access resource.')
 
+    def test_auth_denials_in_metrics(self):
+        self.client().delete(
+            '/movies/1',
+            headers={
+                'Authorization': f'Bearer {self.director}'})
+
+        res = self.client().get('/metrics')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(
+            data['metrics']['auth_denials']['delete_movie']['403'])
+
     # tests for executive producer role, should test for success
     def test_auth_success_get_movie(self):
         res = self.client().get(
@@ -0,0 +1,292 @@
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import create_app
+from admission import token_rate_limiter
+from auth.policy import permission_mask
+from database.models import setup_db, init_db_data, db, Movie, Actor
+from database.cache import movie_cache
+from jobs import enqueue
+
+'''
+Performance regression gate
+
+Runs each route against a seeded local database and records, per request:
+
+    queries   statements sent to the database
+    commits   transactions committed
+    peak_kb   peak memory allocated while serving it (tracemalloc)
+    wall_ms   median time to serve it
+
+and compares them with perf_baseline.json. A route fails if it sends more
+queries or commits than its baseline, or uses more than PERF_MEMORY_TOLERANCE
+more memory or PERF_TIME_TOLERANCE more time (plus PERF_TIME_SLACK_MS).
+Auth is mocked, so no tokens or network access are needed. Runs on a SQLite
+file by default, or on PERF_DATABASE_URL (i.e. a local PostgreSQL):
+
+    python -m unittest test_perf
+
+Baselines are kept per database dialect in perf_baseline.json, which is
+committed. A dialect or route without a baseline fails. After an intended
+change, or to add a dialect or route, record new baselines with
+PERF_UPDATE_BASELINE=true and commit perf_baseline.json.
+'''
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'perf_baseline.json')
+PERF_DATABASE_URL = os.environ.get(
+    'PERF_DATABASE_URL', 'sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'castingagency_perf.db'))
+PERF_UPDATE_BASELINE = os.environ.get('PERF_UPDATE_BASELINE') == 'true'
+PERF_MEMORY_TOLERANCE = float(os.environ.get('PERF_MEMORY_TOLERANCE', 0.25))
+PERF_TIME_TOLERANCE = float(os.environ.get('PERF_TIME_TOLERANCE', 1.0))
+PERF_TIME_SLACK_MS = float(os.environ.get('PERF_TIME_SLACK_MS', 5))
+PERF_RUNS = int(os.environ.get('PERF_RUNS', 5))
+# movies seeded on top of the test data, each with 10 actors, so a route that
+# queries once per row shows it in its query count
+PERF_SEED_MOVIES = int(os.environ.get('PERF_SEED_MOVIES', 20))
+# actors cast in each movie deleted by the DELETE /movies route, below
+# ASYNC_CAST_THRESHOLD so the delete runs inline
+PERF_CAST_SIZE = int(os.environ.get('PERF_CAST_SIZE', 200))
+
+PERMISSIONS = [
+    'get:movies', 'get:actors', 'post:movies', 'post:actors', 'patch:movies',
+    'patch:actors', 'delete:movies', 'delete:actors', 'read:admin']
+
+NEW_MOVIE = {'title': 'Perf Movie', 'release': '2023-01-15'}
+NEW_ACTOR = {'name': 'Perf Actor', 'age': 40, 'gender': 'Male',
+             'movie_id': 1}
+
+
+def _new_actor_id():
+    actor = Actor(name='Perf Delete', age=30, gender='Female')
+    actor.insert()
+    return actor.id
+
+
+def _new_movie_with_cast():
+    movie = Movie(title='Perf Cast', release=datetime(2023, 1, 1))
+    db.session.add(movie)
+    db.session.flush()
+    for i in range(PERF_CAST_SIZE):
+        actor = Actor(name=f'Perf Cast {i}', age=20 + i % 60, gender='Male')
+        actor.cast_in(movie.id, role=f'Role {i}')
+        db.session.add(actor)
+    db.session.commit()
+    return movie.id
+
+
+def _new_casting():
+    actor = Actor(name='Perf Uncast', age=30, gender='Female')
+    actor.cast_in(4)
+    actor.insert()
+    return 4, actor.id
+
+
+def _new_job_id():
+    return enqueue('delete_movie', movie_id=0).id
+
+
+# (method, path, body, setup). setup, if given, runs before every request,
+# outside of what is measured, and returns the value(s) the path is
+# formatted with
+ROUTES = [
+    ('GET', '/movies', None, None),
+    ('GET', '/movies?ids=1,2,3,4,5', None, None),
+    ('GET', '/actors', None, None),
+    ('GET', '/actors?ids=1,2,3,4,5,6,7,8,9,10', None, None),
+    ('GET', '/movies/4/actors', None, None),
+    ('GET', '/movies/casts?ids=4,5,6', None, None),
+    ('GET', '/actors/filmographies?ids=1,2,3', None, None),
+    ('GET', '/changes?limit=100', None, None),
+    ('GET', '/stats', None, None),
+    ('GET', '/stats/movies/4', None, None),
+    ('POST', '/movies', NEW_MOVIE, None),
+    ('POST', '/actors', NEW_ACTOR, None),
+    ('POST', '/actors', [NEW_ACTOR] * 10, None),
+    ('PATCH', '/movies/2', {'title': 'Renamed'}, None),
+    ('PATCH', '/actors/2', {'age': 33}, None),
+    ('POST', '/movies/5/actors', {'actor_id': 3, 'role': 'Lead'}, None),
+    ('DELETE', '/actors/{}', None, _new_actor_id),
+    ('DELETE', '/movies/{}', None, _new_movie_with_cast),
+    ('DELETE', '/movies/{}?async=true', None, _new_movie_with_cast),
+    ('DELETE', '/movies/{}/actors/{}', None, _new_casting),
+    ('POST', '/movies/4/actors/reassign', {'to_movie_id': 5}, None),
+    ('GET', '/jobs/{}', None, _new_job_id),
+]
+
+
+def seed(movies=PERF_SEED_MOVIES, actors_per_movie=10):
+    first_release = datetime(2022, 1, 1)
+    new_movies = [
+        Movie(title=f'Seed Movie {i}',
+              release=first_release + timedelta(days=i))
+        for i in range(movies)]
+    db.session.add_all(new_movies)
+    db.session.flush()
+
+    for movie in new_movies:
+        for i in range(actors_per_movie):
+            actor = Actor(
+                name=f'Seed Actor {movie.id}-{i}', age=20 + i,
+                gender='Female' if i % 2 else 'Male')
+            actor.cast_in(movie.id, role=f'Role {i}')
+            db.session.add(actor)
+    db.session.commit()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = 0
+        self.commits = 0
+
+    def count_query(self, *args):
+        self.queries += 1
+
+    def count_commit(self, *args):
+        self.commits += 1
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self.count_query)
+        event.listen(Engine, 'commit', self.count_commit)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, 'before_cursor_execute', self.count_query)
+        event.remove(Engine, 'commit', self.count_commit)
+
+
+def load_baselines():
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baselines(baselines):
+    with open(BASELINE_PATH, 'w') as baseline_file:
+        json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+class PerformanceTestCase(unittest.TestCase):
+    """Compares each route's cost against its recorded baseline."""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, PERF_DATABASE_URL)
+
+        with self.app.app_context():
+            init_db_data()
+            seed()
+            self.dialect = db.engine.dialect.name
+
+        # every permission, checked the same way a verified token's are
+        payload = {'sub': 'perf-test', 'permissions': PERMISSIONS}
+        patches = [
+            mock.patch('auth.auth.verify_token', return_value=(
+                payload, permission_mask(PERMISSIONS))),
+            mock.patch.object(token_rate_limiter, 'rate', 0),
+            # the movie cache reads the change log on its first use only, so
+            # query counts do not depend on how long a run takes
+            mock.patch.object(movie_cache, 'sync_interval', float('inf'))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    # the route's path, after running its setup
+    def prepare(self, path, setup):
+        if not setup:
+            return path
+
+        with self.app.app_context():
+            values = setup()
+        if not isinstance(values, tuple):
+            values = (values,)
+        return path.format(*values)
+
+    def request(self, method, path, body):
+        return self.client().open(
+            path, method=method, json=body,
+            headers={'Authorization': 'Bearer perf-test'})
+
+    # measure(route)
+    #   one warm-up request, one counted under tracemalloc, then PERF_RUNS
+    #   timed ones. Setup runs before each, outside of what is measured.
+    def measure(self, method, path, body, setup):
+        res = self.request(method, self.prepare(path, setup), body)
+        self.assertLess(res.status_code, 300, f'{method} {path}: {res.data}')
+
+        prepared = self.prepare(path, setup)
+        tracemalloc.start()
+        with QueryCounter() as counter:
+            self.request(method, prepared, body)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        timings = []
+        for _ in range(PERF_RUNS):
+            prepared = self.prepare(path, setup)
+            started = time.perf_counter()
+            self.request(method, prepared, body)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        return {
+            'queries': counter.queries,
+            'commits': counter.commits,
+            'peak_kb': round(peak / 1024, 1),
+            'wall_ms': round(statistics.median(timings), 2)
+        }
+
+    def test_routes_against_baseline(self):
+        results = {
+            f'{method} {path}': self.measure(method, path, body, setup)
+            for method, path, body, setup in ROUTES}
+
+        baselines = load_baselines()
+        if PERF_UPDATE_BASELINE:
+            baselines[self.dialect] = results
+            save_baselines(baselines)
+            return
+
+        self.assertIn(
+            self.dialect, baselines,
+            f'no {self.dialect} baseline, record one with '
+            f'PERF_UPDATE_BASELINE=true')
+        baseline = baselines[self.dialect]
+        for route, result in results.items():
+            with self.subTest(route=route):
+                self.assertIn(
+                    route, baseline,
+                    'no baseline, record one with PERF_UPDATE_BASELINE=true')
+                expected = baseline[route]
+
+                self.assertLessEqual(
+                    result['queries'], expected['queries'], 'more queries')
+                self.assertLessEqual(
+                    result['commits'], expected['commits'], 'more commits')
+                self.assertLessEqual(
+                    result['peak_kb'],
+                    expected['peak_kb'] * (1 + PERF_MEMORY_TOLERANCE),
+                    'more memory')
+                self.assertLessEqual(
+                    result['wall_ms'],
+                    expected['wall_ms'] * (1 + PERF_TIME_TOLERANCE) +
+                    PERF_TIME_SLACK_MS,
+                    'slower')
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
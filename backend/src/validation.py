@@ -0,0 +1,197 @@
+import re
+from datetime import datetime
+
+from werkzeug.exceptions import UnprocessableEntity
+
+from database.cache import movie_cache
+
+'''
+Request validation
+
+Request bodies are checked against schemas built once, at import, before any
+of their values reach a model or the database. Values are coerced to the
+column's type (i.e. '40' to 40, '2022-01-31' to a datetime), and ids that
+reference another row are checked against the movie cache. Invalid requests
+fail with a 422 that lists the problem with each field:
+
+    {
+          "error": 422,
+          "message": "unprocessable",
+          "errors": {"release": "expected a date, i.e. 2022-01-31"}
+    }
+
+A list of bodies (i.e. a bulk POST /actors) is validated in a single pass,
+with the ids they reference looked up together, and errors are reported by
+the index of the body they are in.
+'''
+
+MAX_TITLE_LENGTH = 255
+MAX_NAME_LENGTH = 255
+MAX_GENDER_LENGTH = 50
+MAX_ROLE_LENGTH = 255
+MAX_AGE = 150
+
+# '2022-01-31', '2022-1-31' or '2022-01-31T20:00(:00)'
+_ISO_DATE = re.compile(
+    r'(\d{4})-(\d{1,2})-(\d{1,2})(?:[T ](\d{1,2}):(\d{2})(?::(\d{2}))?)?$')
+# the format dates are returned in, i.e. 'Sat, 01 Jan 2022 00:00:00 GMT'
+_HTTP_DATE = '%a, %d %b %Y %H:%M:%S GMT'
+
+
+class ValidationError(UnprocessableEntity):
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = errors
+
+
+# FIELD PARSERS
+#   each returns a function that coerces a value or raises ValueError with
+#   the message reported for the field
+
+
+def string(max_length):
+    def parse(value):
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('expected a non-empty string')
+        value = value.strip()
+        if len(value) > max_length:
+            raise ValueError(f'must be at most {max_length} characters')
+        return value
+    return parse
+
+
+def integer(minimum=None, maximum=None):
+    def parse(value):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError('expected an integer')
+        try:
+            number = int(value)
+        except ValueError:
+            raise ValueError('expected an integer') from None
+        if minimum is not None and number < minimum:
+            raise ValueError(f'must be at least {minimum}')
+        if maximum is not None and number > maximum:
+            raise ValueError(f'must be at most {maximum}')
+        return number
+    return parse
+
+
+def date():
+    def parse(value):
+        if isinstance(value, str):
+            match = _ISO_DATE.match(value.strip())
+            try:
+                if match:
+                    return datetime(*(
+                        int(part) for part in match.groups()
+                        if part is not None))
+                return datetime.strptime(value.strip(), _HTTP_DATE)
+            except ValueError:
+                pass
+        raise ValueError('expected a date, i.e. 2022-01-31')
+    return parse
+
+
+class Field:
+    def __init__(self, parse, required=False, nullable=False,
+                 references=None):
+        self.parse = parse
+        self.required = required
+        self.nullable = nullable
+        # an EntityCache the value must be the id of a row in
+        self.references = references
+
+
+class Schema:
+    def __init__(self, **fields):
+        self._fields = tuple(fields.items())
+        self._references = tuple(
+            (name, field.references) for name, field in self._fields
+            if field.references is not None)
+
+    # validate(body, partial)
+    #   returns the body's known fields, coerced. Unknown fields are ignored.
+    #   With partial=True (for updates) required fields may be left out.
+    def validate(self, body, partial=False):
+        values, errors = self._check([body], partial)
+        if errors[0]:
+            raise ValidationError(errors[0])
+        return values[0]
+
+    # validate_many(bodies, partial)
+    #   validates a list of bodies at once. Errors are reported by the index
+    #   of the body they are in.
+    def validate_many(self, bodies, partial=False):
+        if not isinstance(bodies, list):
+            raise ValidationError({'body': 'expected a list'})
+
+        values, errors = self._check(bodies, partial)
+        if any(errors):
+            raise ValidationError({
+                index: item_errors for index, item_errors in enumerate(errors)
+                if item_errors})
+        return values
+
+    def _check(self, bodies, partial):
+        values = []
+        errors = []
+        for body in bodies:
+            item_values = {}
+            item_errors = {}
+            values.append(item_values)
+            errors.append(item_errors)
+            if not isinstance(body, dict):
+                item_errors['body'] = 'expected an object'
+                continue
+
+            for name, field in self._fields:
+                value = body.get(name)
+                if value is None:
+                    if name in body and not field.nullable:
+                        item_errors[name] = 'may not be null'
+                    elif name not in body and field.required and not partial:
+                        item_errors[name] = 'is required'
+                    elif name in body:
+                        item_values[name] = None
+                    continue
+
+                try:
+                    item_values[name] = field.parse(value)
+                except ValueError as e:
+                    item_errors[name] = str(e)
+
+        # every referenced id is looked up in one go, through the cache
+        for name, cache in self._references:
+            ids = {item[name] for item in values if item.get(name) is not None}
+            if not ids:
+                continue
+
+            rows, missing = cache.get_many(sorted(ids))
+            missing = set(missing)
+            for item, item_errors in zip(values, errors):
+                if item.get(name) in missing:
+                    item_errors[name] = f'no {cache.entity} with id ' \
+                        f'{item[name]}'
+
+        return values, errors
+
+
+MOVIE_SCHEMA = Schema(
+    title=Field(string(MAX_TITLE_LENGTH), required=True),
+    release=Field(date(), required=True)
+)
+
+ACTOR_SCHEMA = Schema(
+    name=Field(string(MAX_NAME_LENGTH), required=True),
+    age=Field(integer(0, MAX_AGE), required=True),
+    gender=Field(string(MAX_GENDER_LENGTH), required=True),
+    movie_id=Field(integer(1), nullable=True, references=movie_cache),
+    role=Field(string(MAX_ROLE_LENGTH), nullable=True)
+)
+
+CASTING_SCHEMA = Schema(
+    actor_id=Field(integer(1), required=True),
+    role=Field(string(MAX_ROLE_LENGTH), nullable=True),
+    start_date=Field(date(), nullable=True),
+    end_date=Field(date(), nullable=True)
+)
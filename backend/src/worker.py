@@ -0,0 +1,8 @@
+from app import create_app
+from jobs import run_worker
+
+# runs the background job worker, i.e. `python worker.py` from within
+# backend/src. Any number of workers can run against the same database.
+if __name__ == '__main__':
+    with create_app().app_context():
+        run_worker()
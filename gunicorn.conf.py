@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+
+'''
+gunicorn configuration, used by the Procfile:
+
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+Requests spend most of their time waiting on Auth0 and PostgreSQL, so the
+default is threaded workers. Every setting can be overridden from the
+environment:
+
+    GUNICORN_WORKER_CLASS   'gthread' (default), 'gevent' or 'sync'
+    WEB_CONCURRENCY         worker processes (default depends on CPU count)
+    GUNICORN_THREADS        threads per gthread worker (default 4)
+    GUNICORN_PRELOAD        'true' to build the app once in the master
+    GUNICORN_MAX_REQUESTS   requests before a worker is recycled (0 = never)
+    GUNICORN_TIMEOUT        seconds before a silent worker is restarted
+'''
+
+cpus = multiprocessing.cpu_count()
+
+chdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend',
+                     'src')
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+if worker_class == 'sync':
+    # one request at a time per process, so more processes are needed
+    workers = int(os.environ.get('WEB_CONCURRENCY', cpus * 2 + 1))
+else:
+    workers = int(os.environ.get('WEB_CONCURRENCY', cpus + 1))
+if worker_class == 'gevent':
+    worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 100))
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'false') == 'true'
+
+# workers are recycled gracefully after a number of requests, jittered so they
+# do not all restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max(max_requests // 10, 1) if max_requests else 0
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+
+# with a preloaded app the master's connection pool would be copied into
+# every worker, so it is emptied before each fork
+def pre_fork(server, worker):
+    if server.cfg.preload_app:
+        from database.models import db
+
+        with server.app.wsgi().app_context():
+            db.engine.dispose()
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # makes psycopg2 cooperate with gevent instead of blocking the worker
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            server.log.warning('psycogreen is not installed, database calls '
+                               'will block gevent workers')
+
+    if server.cfg.preload_app:
+        from app import reinit_after_fork
+
+        reinit_after_fork(server.app.wsgi())
@@ -1,14 +1,72 @@
+import os
+import sys
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from backend.src.app import APP as app
-from backend.src.database.models import db
+# the app imports its modules relative to backend/src, so they are imported
+# the same way here rather than a second time as backend.src.*
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend', 'src'))
+
+from app import create_app  # noqa: E402
+from database.models import db  # noqa: E402
+from database.stats import rebuild_stats  # noqa: E402
+from database.tenants import drop_tenant as drop_tenant_rows  # noqa: E402
+from idempotency import purge_expired_keys  # noqa: E402
+from snapshots import write_snapshots  # noqa: E402
+from slow_queries import top_slow_queries  # noqa: E402
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def refresh_stats():
+    """Recomputes the /stats counters from the Movie and Actor tables."""
+    rebuild_stats()
+
+
+@manager.command
+def purge_idempotency_keys():
+    """Deletes expired Idempotency-Key records."""
+    print(f'{purge_expired_keys()} expired idempotency keys deleted')
+
+
+@manager.command
+def drop_tenant(tenant):
+    """Deletes every row that belongs to a tenant."""
+    for table, deleted in drop_tenant_rows(tenant).items():
+        print(f'{table}: {deleted} rows deleted')
+
+
+@manager.option('-d', '--directory', dest='directory', default='snapshots')
+@manager.option('-f', '--format', dest='file_format', default='parquet',
+                choices=['parquet', 'arrow'])
+@manager.option('-t', '--tenant', dest='tenant', default=None)
+def snapshot(directory, file_format, tenant):
+    """Writes the movies, actors and cast tables to columnar files."""
+    for name, written in write_snapshots(
+            directory, file_format, tenant).items():
+        print(f'{name}: {written["rows"]} rows, {written["bytes"]} bytes, '
+              f'{written["path"]}')
+
+
+@manager.option('-l', '--limit', dest='limit', type=int, default=20)
+@manager.option('-p', '--plans', dest='plans', action='store_true')
+def slow_queries(limit, plans):
+    """Reports the slow queries with the most total time."""
+    print(f'{"total ms":>12}{"calls":>8}{"mean ms":>10}{"max ms":>10}  '
+          f'statement')
+    for query in top_slow_queries(limit):
+        print(f'{query.total_ms:12.1f}{query.calls:8}'
+              f'{query.total_ms / query.calls:10.1f}{query.max_ms:10.1f}  '
+              f'{query.statement[:200]}')
+        if plans and query.plan:
+            print(query.plan)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,37 @@
+"""idempotency keys
+
+Revision ID: 2c6f8b0d4e17
+Revises: 9d3a7c1e5b64
+Create Date: 2026-10-19 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c6f8b0d4e17'
+down_revision = '9d3a7c1e5b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'IdempotencyKey',
+        sa.Column('subject', sa.String(), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('request_hash', sa.String(length=64), nullable=False),
+        sa.Column('status_code', sa.Integer(), nullable=True),
+        sa.Column('response_body', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('subject', 'key')
+    )
+    op.create_index(
+        'ix_IdempotencyKey_expires_at', 'IdempotencyKey', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_IdempotencyKey_expires_at', table_name='IdempotencyKey')
+    op.drop_table('IdempotencyKey')
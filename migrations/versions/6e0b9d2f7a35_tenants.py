@@ -0,0 +1,50 @@
+"""tenant_id on catalog tables
+
+Revision ID: 6e0b9d2f7a35
+Revises: 2c6f8b0d4e17
+Create Date: 2026-10-19 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e0b9d2f7a35'
+down_revision = '2c6f8b0d4e17'
+branch_labels = None
+depends_on = None
+
+# existing rows belong to the studio the deployment served so far
+TABLES = ['Movie', 'Actor', 'Casting', 'CatalogStat', 'ChangeLog', 'Job']
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column(
+            'tenant_id', sa.String(), nullable=False,
+            server_default='default'))
+
+    op.create_index('ix_Movie_tenant_id_id', 'Movie', ['tenant_id', 'id'])
+    op.create_index('ix_Actor_tenant_id_id', 'Actor', ['tenant_id', 'id'])
+    op.create_index(
+        'ix_Casting_tenant_id_movie_id', 'Casting', ['tenant_id', 'movie_id'])
+    op.create_index(
+        'ix_ChangeLog_tenant_id_id', 'ChangeLog', ['tenant_id', 'id'])
+
+    op.drop_constraint('CatalogStat_pkey', 'CatalogStat', type_='primary')
+    op.create_primary_key(
+        'CatalogStat_pkey', 'CatalogStat', ['tenant_id', 'name', 'key'])
+
+
+def downgrade():
+    op.drop_constraint('CatalogStat_pkey', 'CatalogStat', type_='primary')
+    op.create_primary_key('CatalogStat_pkey', 'CatalogStat', ['name', 'key'])
+
+    op.drop_index('ix_ChangeLog_tenant_id_id', table_name='ChangeLog')
+    op.drop_index('ix_Casting_tenant_id_movie_id', table_name='Casting')
+    op.drop_index('ix_Actor_tenant_id_id', table_name='Actor')
+    op.drop_index('ix_Movie_tenant_id_id', table_name='Movie')
+
+    for table in reversed(TABLES):
+        op.drop_column(table, 'tenant_id')
@@ -0,0 +1,32 @@
+"""catalog stat counters
+
+Revision ID: 8a4e6d0c51f2
+Revises: 3f1c2a9d7b10
+Create Date: 2026-10-19 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6d0c51f2'
+down_revision = '3f1c2a9d7b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'CatalogStat',
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'key')
+    )
+    # counters for an existing catalog are seeded with
+    # `python manage.py refresh_stats`
+
+
+def downgrade():
+    op.drop_table('CatalogStat')
@@ -0,0 +1,28 @@
+"""row versions for optimistic concurrency
+
+Revision ID: 9d3a7c1e5b64
+Revises: 4b8f1e6d2a95
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3a7c1e5b64'
+down_revision = '4b8f1e6d2a95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Movie', sa.Column(
+        'version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('Actor', sa.Column(
+        'version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('Actor', 'version')
+    op.drop_column('Movie', 'version')
@@ -0,0 +1,39 @@
+"""slow query log
+
+Revision ID: a83c5e1f9d26
+Revises: 6e0b9d2f7a35
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83c5e1f9d26'
+down_revision = '6e0b9d2f7a35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'SlowQuery',
+        sa.Column('fingerprint', sa.String(length=40), nullable=False),
+        sa.Column('statement', sa.Text(), nullable=False),
+        sa.Column('calls', sa.Integer(), nullable=False),
+        sa.Column('total_ms', sa.Float(), nullable=False),
+        sa.Column('max_ms', sa.Float(), nullable=False),
+        sa.Column('parameter_shapes', sa.JSON(), nullable=True),
+        sa.Column('endpoints', sa.JSON(), nullable=True),
+        sa.Column('plan', sa.Text(), nullable=True),
+        sa.Column('first_seen', sa.DateTime(), nullable=False),
+        sa.Column('last_seen', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('fingerprint')
+    )
+    op.create_index('ix_SlowQuery_total_ms', 'SlowQuery', ['total_ms'])
+
+
+def downgrade():
+    op.drop_index('ix_SlowQuery_total_ms', table_name='SlowQuery')
+    op.drop_table('SlowQuery')
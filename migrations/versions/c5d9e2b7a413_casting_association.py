@@ -0,0 +1,54 @@
+"""many-to-many castings
+
+Revision ID: c5d9e2b7a413
+Revises: 8a4e6d0c51f2
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d9e2b7a413'
+down_revision = '8a4e6d0c51f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'Casting',
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('role', sa.String(), nullable=True),
+        sa.Column('start_date', sa.DateTime(), nullable=True),
+        sa.Column('end_date', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ['actor_id'], ['Actor.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(
+            ['movie_id'], ['Movie.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(
+        'ix_Casting_actor_id_movie_id', 'Casting', ['actor_id', 'movie_id'])
+
+    # every actor's current movie becomes their first casting
+    op.execute(
+        'INSERT INTO "Casting" (movie_id, actor_id) '
+        'SELECT movie_id, id FROM "Actor" WHERE movie_id IS NOT NULL')
+    op.drop_column('Actor', 'movie_id')
+
+
+def downgrade():
+    op.add_column(
+        'Actor', sa.Column('movie_id', sa.Integer(), nullable=True))
+    op.create_foreign_key(None, 'Actor', 'Movie', ['movie_id'], ['id'])
+
+    # actors cast in several movies keep the most recently added one
+    op.execute(
+        'UPDATE "Actor" SET movie_id = ('
+        'SELECT max(movie_id) FROM "Casting" '
+        'WHERE "Casting".actor_id = "Actor".id)')
+    op.drop_index('ix_Casting_actor_id_movie_id', table_name='Casting')
+    op.drop_table('Casting')
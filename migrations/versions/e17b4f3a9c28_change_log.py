@@ -0,0 +1,32 @@
+"""append-only change log
+
+Revision ID: e17b4f3a9c28
+Revises: c5d9e2b7a413
+Create Date: 2026-10-19 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e17b4f3a9c28'
+down_revision = 'c5d9e2b7a413'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'ChangeLog',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('entity', sa.String(), nullable=False),
+        sa.Column('entity_id', sa.String(), nullable=False),
+        sa.Column('operation', sa.String(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('ChangeLog')